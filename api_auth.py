@@ -0,0 +1,201 @@
+"""
+Authentication for the mobile API.
+
+Clients log in once with email + password and receive a short-lived signed
+access token plus a longer-lived refresh token. Access tokens are verified
+from their signature alone, so authenticated endpoints no longer hash a
+password or touch the database. Clients that still send email + password in
+the JSON body keep working through the same decorator, backed by a short-lived
+cache of recently verified credentials.
+"""
+
+import hashlib
+import hmac
+import secrets
+from functools import wraps
+
+from flask import request, g, current_app
+from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
+
+from cache import TTLCache, get_shared_backend
+from config import (
+    SECRET_KEY,
+    API_ACCESS_TOKEN_TTL,
+    API_REFRESH_TOKEN_TTL,
+    CREDENTIAL_CACHE_SIZE,
+    CREDENTIAL_CACHE_TTL,
+    CROSS_WORKER_CACHES,
+)
+from db import get_db
+from hashing import HashPoolBusy, RETRY_AFTER, verify_password
+from models import parse_config
+
+_access_serializer = URLSafeTimedSerializer(SECRET_KEY, salt='api-access-token')
+_refresh_serializer = URLSafeTimedSerializer(SECRET_KEY, salt='api-refresh-token')
+
+# Access tokens revoked before their expiry, by jti, in the shared backend so
+# that every worker rejects them. Entries expire with the token they revoke.
+REVOKED_TOKEN_KEY = 'api:revoked:{}'
+
+# Recently verified email + password pairs, keyed by an HMAC digest so that
+# plaintext credentials are never held in memory beyond the request.
+# Values are (version, user row with the password hash stripped); the version
+# is a per-user counter in the shared backend, so invalidating a user through
+# one worker invalidates every worker's entries.
+CREDENTIAL_VERSION_KEY = 'credentials:version:{}'
+credential_cache = TTLCache(CREDENTIAL_CACHE_SIZE, CREDENTIAL_CACHE_TTL)
+
+
+def token_version(config):
+    """Return the token version stored in a user's config."""
+    return int(parse_config(config).get('token_version', 0))
+
+
+def issue_tokens(user_data):
+    """Issue an access/refresh token pair for a (id, username, email, _, config) row."""
+    version = token_version(user_data[4])
+    access_token = _access_serializer.dumps({
+        'uid': user_data[0],
+        'usr': user_data[1],
+        'eml': user_data[2],
+        'tv': version,
+        'jti': secrets.token_urlsafe(8),
+    })
+    refresh_token = _refresh_serializer.dumps({
+        'uid': user_data[0],
+        'tv': version,
+        'jti': secrets.token_urlsafe(8),
+    })
+    return {
+        'access_token': access_token,
+        'refresh_token': refresh_token,
+        'token_type': 'Bearer',
+        'expires_in': API_ACCESS_TOKEN_TTL,
+    }
+
+
+def verify_access_token(token):
+    """Return the claims of a valid, unrevoked access token, or None."""
+    try:
+        claims = _access_serializer.loads(token, max_age=API_ACCESS_TOKEN_TTL)
+    except (BadSignature, SignatureExpired):
+        return None
+    try:
+        if get_shared_backend().get(REVOKED_TOKEN_KEY.format(claims.get('jti'))):
+            return None
+    except Exception as e:
+        # Never take the API down because the backend is down; revoked
+        # tokens still expire within API_ACCESS_TOKEN_TTL
+        current_app.logger.warning(f"Token revocation list unavailable: {e}")
+    return claims
+
+
+def verify_refresh_token(token):
+    """Return the claims of a validly signed, unexpired refresh token, or None."""
+    try:
+        return _refresh_serializer.loads(token, max_age=API_REFRESH_TOKEN_TTL)
+    except (BadSignature, SignatureExpired):
+        return None
+
+
+def revoke_access_token(claims):
+    """Reject an access token in every worker until it would have expired."""
+    get_shared_backend().set(REVOKED_TOKEN_KEY.format(claims['jti']), True, ttl=API_ACCESS_TOKEN_TTL)
+
+
+def _credential_key(email, password):
+    message = f"{email}\0{password}".encode('utf-8')
+    return hmac.new(SECRET_KEY.encode('utf-8'), message, hashlib.sha256).hexdigest()
+
+
+def invalidate_user_credentials(user_id):
+    """
+    Forget cached credentials for a user in every worker.
+
+    Call this whenever the user's config or password changes.
+    """
+    credential_cache.delete_where(lambda entry: entry[1][0] == user_id)
+    get_shared_backend().incr(CREDENTIAL_VERSION_KEY.format(user_id))
+
+
+def _remember_credentials(cursor, key, user_data):
+    """
+    Cache a verified user row under the user's current version. The row was
+    read before the version, so it is re-checked afterwards: a change
+    committed in between would otherwise be cached as current.
+    """
+    version = get_shared_backend().get_counter(CREDENTIAL_VERSION_KEY.format(user_data[0]))
+    cursor.execute("SELECT password_hash, config FROM users WHERE id = %s", (user_data[0],))
+    if cursor.fetchone() == (user_data[3], user_data[4]):
+        credential_cache.set(key, (version, (user_data[0], user_data[1], user_data[2], None, user_data[4])))
+
+
+def authenticate_credentials(data):
+    """Authenticate a user from JSON data. Returns (user_tuple, error_response)."""
+    if not data or 'email' not in data or 'password' not in data:
+        return None, ({'error': 'email and password are required'}, 400)
+
+    email = data['email']
+    password = data['password']
+
+    key = _credential_key(email, password)
+    try:
+        cached = credential_cache.get(key) if CROSS_WORKER_CACHES else None
+        if cached is not None:
+            version, user_data = cached
+            if get_shared_backend().get_counter(CREDENTIAL_VERSION_KEY.format(user_data[0])) == version:
+                return user_data, None
+    except Exception as e:
+        current_app.logger.warning(f"Credential cache unavailable: {e}")
+
+    try:
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT id, username, email, password_hash, config FROM users WHERE email = %s",
+            (email,)
+        )
+        user_data = cursor.fetchone()
+
+        if not user_data or not verify_password(user_data[3], password):
+            return None, ({'error': 'Invalid email or password'}, 401)
+
+        if CROSS_WORKER_CACHES:
+            _remember_credentials(cursor, key, user_data)
+        return user_data, None
+
+    except HashPoolBusy as e:
+        current_app.logger.warning(f"Auth rejected: {e}")
+        return None, ({'error': 'Server busy, try again shortly'}, 503, {'Retry-After': str(RETRY_AFTER)})
+    except Exception as e:
+        current_app.logger.error(f"Auth error: {e}")
+        return None, ({'error': 'Authentication failed'}, 500)
+
+
+def api_auth_required(view):
+    """
+    Authenticate an API request before running the view.
+
+    Accepts an `Authorization: Bearer <access token>` header, falling back to
+    email + password in the JSON body for older clients. The authenticated
+    user is stored in `g.api_user` as an (id, username, email, password_hash,
+    config) tuple; token requests carry None for the last two.
+    """
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        header = request.headers.get('Authorization', '')
+        if header.startswith('Bearer '):
+            claims = verify_access_token(header[len('Bearer '):].strip())
+            if claims is None:
+                return {'error': 'Invalid or expired token'}, 401
+            g.api_user = (claims['uid'], claims['usr'], claims['eml'], None, None)
+            g.api_token = claims
+        else:
+            user_data, err = authenticate_credentials(request.get_json(silent=True))
+            if err:
+                return err
+            g.api_user = user_data
+            g.api_token = None
+        return view(*args, **kwargs)
+
+    return wrapped
@@ -1,8 +1,16 @@
 from flask import Flask
 from flask_login import LoginManager
+from werkzeug.middleware.proxy_fix import ProxyFix
 
-from config import SECRET_KEY
+import db
+import ingest
+import instrumentation
+import ratelimit
+from assets import AssetPipeline
+from config import SECRET_KEY, SCHEMA_CHECK_ON_STARTUP, TRUSTED_PROXY_COUNT
+from migrate import check_required_indexes
 from models import load_user_by_id
+from rollup import rollup_cli
 
 # Import blueprints
 from routes.auth import auth_bp
@@ -18,6 +26,28 @@ application = app
 # Configuration
 app.secret_key = SECRET_KEY
 
+if TRUSTED_PROXY_COUNT:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_COUNT, x_proto=TRUSTED_PROXY_COUNT)
+
+# Request timing, Server-Timing headers and /metrics
+instrumentation.init_app(app)
+
+# Fingerprinted, pre-compressed static files (see assets.py)
+AssetPipeline(app)
+
+# Per-process database connection pool
+db.init_app(app)
+
+# Drain the write-behind ingestion queue on shutdown (see ingest.py)
+ingest.init_app(app)
+
+# Fail fast if migrations haven't been applied (see migrate.py)
+if SCHEMA_CHECK_ON_STARTUP:
+    check_required_indexes()
+
+# Throttle logins, registrations and credential checks (see config.RATE_LIMITS)
+ratelimit.init_app(app)
+
 # Setup Flask-Login
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -36,6 +66,9 @@ app.register_blueprint(poop_bp)
 app.register_blueprint(user_bp)
 app.register_blueprint(api_bp)
 
+# CLI commands
+app.cli.add_command(rollup_cli)
+
 
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,161 @@
+"""
+Static asset pipeline.
+
+Templates link assets with `asset_url('css/home.css')`, which returns a URL
+containing a hash of the file's content (/assets/css/home.3f9a1c2b7d4e.css).
+Because the URL changes whenever the file does, responses are cached by
+browsers forever (`Cache-Control: immutable`), so repeat visits never ask
+for them again.
+
+`python assets.py build` runs at deploy time (see bin/post_compile). It
+writes the fingerprinted copies plus gzip and, if the optional `brotli`
+package is installed, brotli variants to static/dist/, along with the
+manifest the app loads on startup. Without a build (e.g. in development),
+the hashes are computed in memory at startup and the original files are
+served uncompressed.
+
+This module doesn't import config, so the build runs without the database
+settings.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import sys
+
+from flask import abort, request, send_file, url_for
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+DIST_DIR = os.path.join(STATIC_DIR, 'dist')
+MANIFEST_PATH = os.path.join(DIST_DIR, 'manifest.json')
+
+# Extensions worth pre-compressing (icons and images are already compressed or tiny)
+COMPRESSIBLE = ('.css', '.js', '.svg', '.json', '.txt')
+
+ONE_YEAR = 365 * 24 * 3600
+
+# Content-Encoding -> file suffix, in order of preference
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+def _source_files():
+    """Yield the path of every static file relative to STATIC_DIR, skipping build output."""
+    for root, dirs, files in os.walk(STATIC_DIR):
+        dirs[:] = sorted(d for d in dirs if os.path.join(root, d) != DIST_DIR)
+        for name in sorted(files):
+            yield os.path.relpath(os.path.join(root, name), STATIC_DIR).replace(os.sep, '/')
+
+
+def fingerprinted_name(filename, content):
+    """'css/home.css' -> 'css/home.<hash>.css'"""
+    digest = hashlib.sha256(content).hexdigest()[:12]
+    base, ext = os.path.splitext(filename)
+    return f"{base}.{digest}{ext}"
+
+
+def scan():
+    """Return {filename: fingerprinted name} for every static file."""
+    manifest = {}
+    for filename in _source_files():
+        with open(os.path.join(STATIC_DIR, filename), 'rb') as f:
+            manifest[filename] = fingerprinted_name(filename, f.read())
+    return manifest
+
+
+def _compress_brotli(content):
+    try:
+        import brotli  # optional; gzip alone is served without it
+    except ImportError:
+        return None
+    return brotli.compress(content, quality=11)
+
+
+def build(echo=print):
+    """Write fingerprinted and pre-compressed copies plus the manifest to DIST_DIR."""
+    manifest = {}
+    for filename in _source_files():
+        with open(os.path.join(STATIC_DIR, filename), 'rb') as f:
+            content = f.read()
+        hashed = fingerprinted_name(filename, content)
+        manifest[filename] = hashed
+
+        target = os.path.join(DIST_DIR, hashed)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        variants = {'': content}
+        if filename.endswith(COMPRESSIBLE):
+            # mtime=0 keeps the output identical between builds
+            variants['.gz'] = gzip.compress(content, compresslevel=9, mtime=0)
+            compressed = _compress_brotli(content)
+            if compressed is not None:
+                variants['.br'] = compressed
+        for suffix, data in variants.items():
+            with open(target + suffix, 'wb') as f:
+                f.write(data)
+        echo(f"{filename} -> dist/{hashed} ({', '.join(f'{len(d)}B{s}' for s, d in variants.items())})")
+
+    with open(MANIFEST_PATH, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+class AssetPipeline:
+    """Serves fingerprinted assets and provides `asset_url` to templates."""
+
+    def __init__(self, app=None):
+        self.manifest = {}
+        self.version = None  # changes whenever any asset does
+        self.built = False
+        self._sources = {}  # fingerprinted name -> filename
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if os.path.exists(MANIFEST_PATH):
+            with open(MANIFEST_PATH, encoding='utf-8') as f:
+                self.manifest = json.load(f)
+            self.built = True
+        else:
+            self.manifest = scan()
+        self._sources = {hashed: filename for filename, hashed in self.manifest.items()}
+        self.version = hashlib.sha256(json.dumps(self.manifest, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+        app.add_url_rule('/assets/<path:filename>', 'assets', self.serve)
+        app.add_template_global(self.url, 'asset_url')
+        app.extensions['assets'] = self
+
+    def url(self, filename):
+        """URL of a static file under its content hash; unknown files fall back to /static."""
+        hashed = self.manifest.get(filename)
+        if hashed is None:
+            return url_for('static', filename=filename)
+        return url_for('assets', filename=hashed)
+
+    def serve(self, filename):
+        source = self._sources.get(filename)
+        if source is None:
+            abort(404)
+
+        mimetype = mimetypes.guess_type(source)[0] or 'application/octet-stream'
+        path, encoding = os.path.join(STATIC_DIR, source), None
+        if self.built:
+            path = os.path.join(DIST_DIR, filename)
+            for name, suffix in ENCODINGS:
+                if name in request.accept_encodings and os.path.exists(path + suffix):
+                    path, encoding = path + suffix, name
+                    break
+
+        response = send_file(path, mimetype=mimetype, max_age=ONE_YEAR, conditional=True)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] != ['build']:
+        sys.exit("usage: python assets.py build")
+    build()
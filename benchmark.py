@@ -0,0 +1,392 @@
+"""
+Benchmark suite: seed a throwaway database, drive the hot endpoints and
+report latency percentiles as JSON.
+
+Point the DATABASE_* variables at a local Postgres (never production), e.g.
+
+    docker run -d -p 5432:5432 -e POSTGRES_PASSWORD=bench postgres:16
+    export DATABASE_HOST=localhost DATABASE_USER=postgres DATABASE_PASSWORD=bench \\
+           DATABASE_NAME=postgres DATABASE_SSLMODE=disable
+
+then:
+
+    python migrate.py upgrade
+    python benchmark.py seed --users 10000 --logs 10000000
+    RATE_LIMITS_ENABLED=false gunicorn -c gunicorn.conf.py app:app &
+    python benchmark.py run --base-url http://localhost:8000 --output before.json
+    ... change something, restart the server ...
+    python benchmark.py run --base-url http://localhost:8000 --output after.json
+    python benchmark.py compare before.json after.json
+
+Rate limiting has to be off on the server under test, since every request
+comes from the same address. Queries per request are read from the
+Server-Timing header (see instrumentation.py).
+"""
+
+import json
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from datetime import datetime, timedelta
+
+import click
+from werkzeug.security import generate_password_hash
+
+from db import connect
+
+BENCH_EMAIL_DOMAIN = 'bench.example.com'
+BENCH_PASSWORD = 'benchmark'
+
+ENDPOINTS = ('home', 'api_home', 'api_poop', 'api_poop_metrics', 'api_login')
+
+_DB_TIMING = re.compile(r'(?:^|,)\s*db;dur=[\d.]+;desc="(\d+)x"')
+
+
+@click.group(help='Seed a benchmark database and measure endpoint latency.')
+def benchmark_cli():
+    pass
+
+
+# ── Seeding ────────────────────────────────────────────────────────────────────
+
+def skewed_counts(users, logs, skew):
+    """Split `logs` entries across users with a Zipf-like distribution (a few heavy users, a long tail)."""
+    weights = [1 / (rank ** skew) for rank in range(1, users + 1)]
+    total = sum(weights)
+    counts = [int(logs * w / total) for w in weights]
+    for i in range(logs - sum(counts)):
+        counts[i % users] += 1
+    random.shuffle(counts)
+    return counts
+
+
+def seed(conn, users, logs, skew, days, public_ratio, batch_users=200, echo=print):
+    cursor = conn.cursor()
+    # Everyone shares one password, hashed once rather than per user
+    password_hash = generate_password_hash(BENCH_PASSWORD)
+
+    echo(f"Creating {users} users...")
+    cursor.execute(
+        """
+        INSERT INTO users (username, email, password_hash, config, created_at)
+        SELECT 'bench' || n, 'bench' || n || '@' || %s, %s,
+               jsonb_build_object('public', random() < %s),
+               NOW() - %s * INTERVAL '1 day'
+        FROM generate_series(1, %s) AS n
+        RETURNING id
+        """,
+        (BENCH_EMAIL_DOMAIN, password_hash, public_ratio, days, users)
+    )
+    user_ids = sorted(row[0] for row in cursor.fetchall())
+    conn.commit()
+
+    counts = skewed_counts(users, logs, skew)
+    echo(f"Inserting {logs} log entries (heaviest user: {max(counts)})...")
+    done = 0
+    for start in range(0, users, batch_users):
+        ids = user_ids[start:start + batch_users]
+        batch = counts[start:start + batch_users]
+        # Mostly mornings, the rest spread over the day
+        cursor.execute(
+            """
+            INSERT INTO poop (user_id, log_time)
+            SELECT u.id,
+                   date_trunc('day', NOW() - random() * %s * INTERVAL '1 day')
+                   + (CASE WHEN random() < 0.6 THEN 6 + random() * 4 ELSE random() * 24 END) * INTERVAL '1 hour'
+            FROM unnest(%s::int[], %s::int[]) AS u(id, n), generate_series(1, u.n)
+            """,
+            (days, ids, batch)
+        )
+        conn.commit()
+        done += sum(batch)
+        echo(f"  {done}/{logs}")
+
+    echo("Rebuilding the daily rollup...")
+    cursor.execute(
+        """
+        INSERT INTO poop_daily (user_id, day, count, first_time, last_time)
+        SELECT user_id, log_time::date, COUNT(*), MIN(log_time), MAX(log_time)
+        FROM poop
+        WHERE user_id = ANY(%s)
+        GROUP BY 1, 2
+        """,
+        (user_ids,)
+    )
+    cursor.execute("ANALYZE users; ANALYZE poop; ANALYZE poop_daily")
+    conn.commit()
+
+
+def reset(conn):
+    """Delete every benchmark user and their data."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT id FROM users WHERE email LIKE %s", (f'%@{BENCH_EMAIL_DOMAIN}',))
+    ids = [row[0] for row in cursor.fetchall()]
+    for table in ('poop', 'poop_daily', 'poop_tombstones'):
+        cursor.execute(f"DELETE FROM {table} WHERE user_id = ANY(%s)", (ids,))
+    cursor.execute("DELETE FROM users WHERE id = ANY(%s)", (ids,))
+    conn.commit()
+    return len(ids)
+
+
+@benchmark_cli.command('seed')
+@click.option('--users', default=10_000, show_default=True)
+@click.option('--logs', default=10_000_000, show_default=True, help='Total log entries.')
+@click.option('--skew', default=1.1, show_default=True, help='Zipf exponent of per-user volume.')
+@click.option('--days', default=3 * 365, show_default=True, help='History spread over this many days.')
+@click.option('--public-ratio', default=0.3, show_default=True)
+@click.option('--seed', 'random_seed', default=42, show_default=True)
+def seed_command(users, logs, skew, days, public_ratio, random_seed):
+    """Replace the benchmark users and their logs with fresh data."""
+    random.seed(random_seed)
+    conn = connect()
+    try:
+        removed = reset(conn)
+        if removed:
+            click.echo(f"Removed {removed} previous benchmark users.")
+        seed(conn, users, logs, skew, days, public_ratio, echo=click.echo)
+    finally:
+        conn.close()
+    click.echo("Done.")
+
+
+@benchmark_cli.command('reset')
+def reset_command():
+    """Delete the benchmark users and their logs."""
+    conn = connect()
+    try:
+        click.echo(f"Removed {reset(conn)} benchmark users.")
+    finally:
+        conn.close()
+
+
+# ── Load generation ───────────────────────────────────────────────────────────
+
+class Client:
+    """Minimal HTTP client (stdlib only) that records latency and DB queries per request."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+
+    def request(self, method, path, body=None, token=None):
+        headers = {}
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        if token:
+            headers['Authorization'] = f'Bearer {token}'
+        req = urllib.request.Request(self.base_url + path, data=data, headers=headers, method=method)
+
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(req, timeout=30) as resp:
+                payload = resp.read()
+                status, timing = resp.status, resp.headers.get('Server-Timing', '')
+        except urllib.error.HTTPError as e:
+            payload = e.read()
+            status, timing = e.code, e.headers.get('Server-Timing', '')
+        except (urllib.error.URLError, OSError):
+            return time.perf_counter() - started, 0, None, None
+        elapsed = time.perf_counter() - started
+
+        match = _DB_TIMING.search(timing)
+        return elapsed, status, int(match.group(1)) if match else 0, payload
+
+
+def _pick_user(users):
+    # Heavier users are also the most active ones
+    return users[min(len(users) - 1, int(random.paretovariate(1.2)) - 1)]
+
+
+def login(client, email):
+    _, status, _, payload = client.request('POST', '/api/login', {'email': email, 'password': BENCH_PASSWORD})
+    if status != 200:
+        raise click.ClickException(f"Login failed for {email} (HTTP {status})")
+    return json.loads(payload)['access_token']
+
+
+def make_scenarios(client, users, tokens):
+    """Return endpoint name -> callable issuing one request for a random benchmark user."""
+    def home():
+        user_id, _ = _pick_user(users)
+        return client.request('GET', f'/?user_id={user_id}')
+
+    def api_home():
+        user_id, _ = _pick_user(users)
+        return client.request('POST', '/api/home', {'limit': 100}, token=tokens[user_id])
+
+    def api_poop():
+        user_id, _ = _pick_user(users)
+        when = datetime.now() - timedelta(minutes=random.randint(0, 60 * 24 * 7))
+        return client.request('POST', '/api/poop', {'user_time': when.strftime('%Y-%m-%dT%H:%M')},
+                              token=tokens[user_id])
+
+    def api_poop_metrics():
+        user_id, _ = _pick_user(users)
+        return client.request('GET', '/api/poop/metrics', token=tokens[user_id])
+
+    def api_login():
+        _, email = _pick_user(users)
+        return client.request('POST', '/api/login', {'email': email, 'password': BENCH_PASSWORD})
+
+    return {
+        'home': home,
+        'api_home': api_home,
+        'api_poop': api_poop,
+        'api_poop_metrics': api_poop_metrics,
+        'api_login': api_login,
+    }
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(q * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def drive(scenario, concurrency, duration, warmup):
+    """Run `scenario` from `concurrency` threads; returns the summary of the measured period."""
+    samples = []
+    lock = threading.Lock()
+    started = time.monotonic()
+    measure_from = started + warmup
+    stop_at = measure_from + duration
+
+    def worker():
+        local = []
+        while True:
+            now = time.monotonic()
+            if now >= stop_at:
+                break
+            elapsed, status, queries, _ = scenario()
+            if now >= measure_from:
+                local.append((elapsed, status, queries))
+        with lock:
+            samples.extend(local)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    ok = sorted(s[0] for s in samples if s[1] and s[1] < 400)
+    queries = [s[2] for s in samples if s[1] and s[1] < 400 and s[2] is not None]
+
+    def ms(value):
+        return None if value is None else round(value * 1000, 2)
+
+    return {
+        'requests': len(samples),
+        'errors': len(samples) - len(ok),
+        'throughput_rps': round(len(ok) / duration, 2),
+        'mean_ms': ms(sum(ok) / len(ok)) if ok else None,
+        'p50_ms': ms(percentile(ok, 0.50)),
+        'p95_ms': ms(percentile(ok, 0.95)),
+        'p99_ms': ms(percentile(ok, 0.99)),
+        'max_ms': ms(ok[-1]) if ok else None,
+        'db_queries_per_request': round(sum(queries) / len(queries), 2) if queries else None,
+    }
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@benchmark_cli.command('run')
+@click.option('--base-url', default='http://localhost:8000', show_default=True)
+@click.option('--endpoint', 'endpoints', multiple=True, type=click.Choice(ENDPOINTS),
+              help='Endpoint to drive (repeatable); default all.')
+@click.option('--concurrency', default=16, show_default=True)
+@click.option('--duration', default=30.0, show_default=True, help='Measured seconds per endpoint.')
+@click.option('--warmup', default=5.0, show_default=True, help='Unmeasured seconds per endpoint.')
+@click.option('--sample-users', default=200, show_default=True, help='Benchmark users to log in and drive.')
+@click.option('--output', type=click.Path(dir_okay=False), help='Write the JSON results here too.')
+def run_command(base_url, endpoints, concurrency, duration, warmup, sample_users, output):
+    """Drive each endpoint in turn and report latency percentiles as JSON."""
+    conn = connect()
+    try:
+        cursor = conn.cursor()
+        # Ordered by volume, so that _pick_user favours the heavy users
+        cursor.execute(
+            """
+            SELECT u.id, u.email
+            FROM users u
+            LEFT JOIN poop_daily d ON d.user_id = u.id
+            WHERE u.email LIKE %s
+            GROUP BY u.id
+            ORDER BY COALESCE(SUM(d.count), 0) DESC
+            LIMIT %s
+            """,
+            (f'%@{BENCH_EMAIL_DOMAIN}', sample_users)
+        )
+        users = cursor.fetchall()
+    finally:
+        conn.close()
+    if not users:
+        raise click.ClickException("No benchmark users found; run `python benchmark.py seed` first.")
+
+    client = Client(base_url)
+    click.echo(f"Logging in {len(users)} users...", err=True)
+    tokens = {user_id: login(client, email) for user_id, email in users}
+    scenarios = make_scenarios(client, users, tokens)
+
+    results = {}
+    for name in endpoints or ENDPOINTS:
+        click.echo(f"{name}: {concurrency} clients for {duration:g}s...", err=True)
+        results[name] = drive(scenarios[name], concurrency, duration, warmup)
+
+    report = {
+        'meta': {
+            'revision': _git_revision(),
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'base_url': base_url,
+            'concurrency': concurrency,
+            'duration': duration,
+            'sample_users': len(users),
+        },
+        'results': results,
+    }
+    text = json.dumps(report, indent=2)
+    click.echo(text)
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+
+
+@benchmark_cli.command('compare')
+@click.argument('baseline', type=click.File())
+@click.argument('candidate', type=click.File())
+@click.option('--threshold', default=10.0, show_default=True, help='Allowed p95 regression, in percent.')
+def compare_command(baseline, candidate, threshold):
+    """Compare two result files; exits non-zero if any p95 regressed past the threshold."""
+    before = json.load(baseline)['results']
+    after = json.load(candidate)['results']
+    regressed = False
+    click.echo(f"{'endpoint':<18}{'metric':<24}{'before':>10}{'after':>10}{'change':>10}")
+    for name in sorted(set(before) & set(after)):
+        for metric in ('p50_ms', 'p95_ms', 'p99_ms', 'throughput_rps', 'db_queries_per_request'):
+            old, new = before[name].get(metric), after[name].get(metric)
+            if old is None or new is None:
+                continue
+            change = (new - old) / old * 100 if old else 0.0
+            click.echo(f"{name:<18}{metric:<24}{old:>10}{new:>10}{change:>+9.1f}%")
+            if metric == 'p95_ms' and change > threshold:
+                regressed = True
+    if regressed:
+        click.echo(f"p95 latency regressed by more than {threshold:g}%.")
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    benchmark_cli.main(args=sys.argv[1:], prog_name='benchmark.py')
@@ -0,0 +1,164 @@
+"""
+Caching helpers: an in-process TTL/LRU cache, and a small key/value backend
+interface shared across workers (Redis, or a local in-memory stand-in).
+"""
+
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from config import CACHE_URL
+
+
+class TTLCache:
+    """A thread-safe LRU cache whose entries also expire after `ttl` seconds."""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < now:
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_where(self, predicate):
+        """Drop every entry whose value matches `predicate`."""
+        with self._lock:
+            for key in [k for k, (_, v) in self._data.items() if predicate(v)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+class MemoryBackend:
+    """
+    Process-local key/value store with per-key expiry.
+
+    Stands in for the shared backend when no CACHE_URL is configured (a
+    single worker, development, tests); it offers the same methods.
+    """
+
+    def __init__(self):
+        self._data = {}  # key -> (expires_at or None, value)
+        self._lock = threading.Lock()
+
+    def _live(self, key, now):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry[0] is not None and entry[0] < now:
+            del self._data[key]
+            return None
+        return entry
+
+    def get(self, key):
+        with self._lock:
+            entry = self._live(key, time.monotonic())
+            return entry[1] if entry else None
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl if ttl else None, value)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def get_counter(self, key):
+        """Return the value of a key maintained with incr(), or 0."""
+        return self.get(key) or 0
+
+    def incr(self, key, ttl=None):
+        """Atomically increment an integer key (starting from 0) and return the new value."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._live(key, now)
+            if entry is None:
+                entry = (now + ttl if ttl else None, 0)
+            value = entry[1] + 1
+            self._data[key] = (entry[0], value)
+            return value
+
+
+class RedisBackend:
+    """Shared key/value store on Redis, for setups with several workers or hosts."""
+
+    def __init__(self, url):
+        import redis  # optional dependency, only needed when CACHE_URL is set
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        value = self._client.get(key)
+        if value is None:
+            return None
+        return pickle.loads(value)
+
+    def set(self, key, value, ttl=None):
+        self._client.set(key, pickle.dumps(value), ex=int(ttl) if ttl else None)
+
+    def delete(self, key):
+        self._client.delete(key)
+
+    def get_counter(self, key):
+        return int(self._client.get(key) or 0)
+
+    def incr(self, key, ttl=None):
+        pipe = self._client.pipeline()
+        pipe.incr(key)
+        if ttl:
+            # Only sets an expiry on a fresh key, like MemoryBackend
+            pipe.expire(key, int(ttl), nx=True)
+        return pipe.execute()[0]
+
+
+_shared_backend = None
+_shared_backend_lock = threading.Lock()
+
+
+def get_shared_backend():
+    """
+    Return the backend shared by every worker: Redis when CACHE_URL is set,
+    otherwise a process-local MemoryBackend.
+    """
+    global _shared_backend
+    if _shared_backend is None:
+        with _shared_backend_lock:
+            if _shared_backend is None:
+                _shared_backend = RedisBackend(CACHE_URL) if CACHE_URL else MemoryBackend()
+    return _shared_backend
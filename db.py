@@ -0,0 +1,407 @@
+"""
+PostgreSQL connection pooling and read-replica routing.
+
+Each process (gunicorn worker) owns one pool per server, created lazily on
+first use so that connections are never shared across a fork.
+
+Requests get their primary connection from get_db(). Read-only dashboard
+queries use get_read_db() instead, which hands out a connection to one of
+the DATABASE_REPLICA_URLS servers, round-robin, skipping replicas that fail
+or lag too far behind. Reads of a user whose logs changed in the last
+READ_YOUR_WRITES_WINDOW seconds stay on the primary, so a new entry shows
+up at once.
+"""
+
+import atexit
+import itertools
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+from flask import g, current_app
+
+from cache import get_shared_backend
+from config import (
+    db_config,
+    DB_POOL_MIN_SIZE,
+    DB_POOL_MAX_SIZE,
+    DB_POOL_TIMEOUT,
+    DB_POOL_HEALTHCHECK_AFTER,
+    DATABASE_REPLICA_URLS,
+    REPLICA_MAX_LAG,
+    REPLICA_CHECK_INTERVAL,
+    REPLICA_RETRY_AFTER,
+    READ_YOUR_WRITES_WINDOW,
+)
+from instrumentation import InstrumentedCursor, record
+
+# Longest a read waits for a busy replica's pool before using the primary
+REPLICA_POOL_TIMEOUT = 1.0
+
+RECENT_WRITE_KEY = 'user:recent_write:{}'
+
+
+def connect(dsn=None):
+    """
+    Open a new, unpooled connection (for CLI tools and the pools), to the
+    primary or to the server described by `dsn`.
+    """
+    started = time.perf_counter()
+    if dsn:
+        conn = psycopg2.connect(dsn, cursor_factory=InstrumentedCursor)
+    else:
+        conn = psycopg2.connect(
+            host=db_config['host'],
+            user=db_config['user'],
+            password=db_config['password'],
+            dbname=db_config['database'],
+            sslmode=db_config['sslmode'],
+            cursor_factory=InstrumentedCursor
+        )
+    record('db_connect', time.perf_counter() - started)
+    return conn
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection becomes available within the pool timeout."""
+
+
+class ConnectionPool:
+    """A bounded, thread-safe pool of psycopg2 connections."""
+
+    def __init__(self, min_size, max_size, timeout, healthcheck_after, dsn=None):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.healthcheck_after = healthcheck_after
+
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._idle = []  # list of (connection, last_used)
+        self._size = 0
+        self._closed = False
+
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.discarded = 0
+
+        for _ in range(min_size):
+            self._idle.append((self._connect(), time.monotonic()))
+
+    def _connect(self):
+        conn = connect(self.dsn)
+        with self._lock:
+            self._size += 1
+        return conn
+
+    def _discard(self, conn):
+        with self._lock:
+            self._size -= 1
+            self.discarded += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _is_healthy(self, conn, last_used):
+        """Check a connection that has been idle long enough to have gone stale."""
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.healthcheck_after:
+            return True
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def getconn(self):
+        """Check a connection out of the pool, waiting up to `timeout` seconds."""
+        if self._closed:
+            raise PoolTimeout("Connection pool is closed")
+
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.waits += 1
+            if not self._slots.acquire(timeout=self.timeout):
+                with self._lock:
+                    self.timeouts += 1
+                raise PoolTimeout(f"No database connection available after {self.timeout}s")
+
+        try:
+            while True:
+                with self._lock:
+                    entry = self._idle.pop() if self._idle else None
+                if entry is None:
+                    conn = self._connect()
+                    break
+                conn, last_used = entry
+                if self._is_healthy(conn, last_used):
+                    break
+                self._discard(conn)
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self.checkouts += 1
+        return conn
+
+    def putconn(self, conn):
+        """Return a connection to the pool, resetting any open transaction."""
+        try:
+            if conn.closed:
+                self._discard(conn)
+                return
+            if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except Exception:
+                    self._discard(conn)
+                    return
+            if self._closed:
+                self._discard(conn)
+                return
+            with self._lock:
+                self._idle.append((conn, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """Context manager that checks a connection out and always returns it."""
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def stats(self):
+        """Return a snapshot of the pool metrics."""
+        with self._lock:
+            idle = len(self._idle)
+            return {
+                'size': self._size,
+                'idle': idle,
+                'in_use': self._size - idle,
+                'max_size': self.max_size,
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'timeouts': self.timeouts,
+                'discarded': self.discarded,
+            }
+
+    def close(self):
+        """Close every idle connection; checked-out ones are closed on return."""
+        self._closed = True
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._discard(conn)
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Return this process's connection pool, creating it on first use."""
+    global _pool, _pool_pid
+    pid = os.getpid()
+    if _pool is None or _pool_pid != pid:
+        with _pool_lock:
+            if _pool is None or _pool_pid != pid:
+                _pool = ConnectionPool(
+                    DB_POOL_MIN_SIZE,
+                    DB_POOL_MAX_SIZE,
+                    DB_POOL_TIMEOUT,
+                    DB_POOL_HEALTHCHECK_AFTER,
+                )
+                _pool_pid = pid
+    return _pool
+
+
+class ReplicaSet:
+    """Round-robin pools over the read replicas, skipping unhealthy ones."""
+
+    def __init__(self, dsns):
+        # min_size 0: a replica that is down at startup must not stop the app
+        self.pools = [
+            ConnectionPool(0, DB_POOL_MAX_SIZE, min(DB_POOL_TIMEOUT, REPLICA_POOL_TIMEOUT),
+                           DB_POOL_HEALTHCHECK_AFTER, dsn=dsn)
+            for dsn in dsns
+        ]
+        self._lock = threading.Lock()
+        self._next = itertools.count()
+        self._skip_until = [0.0] * len(self.pools)
+        self._checked_at = [0.0] * len(self.pools)
+        self.fallbacks = 0  # reads sent to the primary because no replica was usable
+
+    def _mark_down(self, index, reason):
+        with self._lock:
+            self._skip_until[index] = time.monotonic() + REPLICA_RETRY_AFTER
+        current_app.logger.warning(f"Read replica {index} skipped for {REPLICA_RETRY_AFTER:g}s: {reason}")
+
+    def _lag(self, conn):
+        """Seconds the replica is behind the primary (0 when it has replayed everything it received)."""
+        cursor = conn.cursor()
+        cursor.execute(
+            """
+            SELECT CASE
+                WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                ELSE COALESCE(EXTRACT(EPOCH FROM NOW() - pg_last_xact_replay_timestamp()), 0)
+            END
+            """
+        )
+        lag = float(cursor.fetchone()[0])
+        conn.rollback()
+        return lag
+
+    def getconn(self):
+        """Return (pool, connection) for the next healthy replica, or (None, None)."""
+        for _ in range(len(self.pools)):
+            index = next(self._next) % len(self.pools)
+            now = time.monotonic()
+            if self._skip_until[index] > now:
+                continue
+            pool = self.pools[index]
+            try:
+                conn = pool.getconn()
+            except Exception as e:
+                self._mark_down(index, e)
+                continue
+
+            if now - self._checked_at[index] >= REPLICA_CHECK_INTERVAL:
+                try:
+                    lag = self._lag(conn)
+                except Exception as e:
+                    pool.putconn(conn)
+                    self._mark_down(index, e)
+                    continue
+                self._checked_at[index] = now
+                if lag > REPLICA_MAX_LAG:
+                    pool.putconn(conn)
+                    self._mark_down(index, f"{lag:.1f}s behind")
+                    continue
+            return pool, conn
+
+        with self._lock:
+            self.fallbacks += 1
+        return None, None
+
+    def stats(self):
+        now = time.monotonic()
+        return [
+            dict(pool.stats(), healthy=int(self._skip_until[i] <= now))
+            for i, pool in enumerate(self.pools)
+        ]
+
+    def close(self):
+        for pool in self.pools:
+            pool.close()
+
+
+_replicas = None
+_replicas_pid = None
+
+
+def get_replicas():
+    """Return this process's ReplicaSet, or None when no replicas are configured."""
+    global _replicas, _replicas_pid
+    if not DATABASE_REPLICA_URLS:
+        return None
+    pid = os.getpid()
+    if _replicas is None or _replicas_pid != pid:
+        with _pool_lock:
+            if _replicas is None or _replicas_pid != pid:
+                _replicas = ReplicaSet(DATABASE_REPLICA_URLS)
+                _replicas_pid = pid
+    return _replicas
+
+
+def close_pool():
+    """Close this process's pools, if they were created."""
+    if _pool is not None and _pool_pid == os.getpid():
+        _pool.close()
+    if _replicas is not None and _replicas_pid == os.getpid():
+        _replicas.close()
+
+
+def mark_recent_write(user_id):
+    """Keep reads of this user's data on the primary for READ_YOUR_WRITES_WINDOW seconds."""
+    if DATABASE_REPLICA_URLS:
+        get_shared_backend().set(RECENT_WRITE_KEY.format(user_id), True, ttl=READ_YOUR_WRITES_WINDOW)
+
+
+def get_db():
+    """
+    Return the connection bound to the current request.
+
+    The first call checks a connection out of the pool; later calls in the
+    same request (user loader, view, helpers) reuse it until teardown.
+    """
+    if 'db_conn' not in g:
+        started = time.perf_counter()
+        g.db_conn = get_pool().getconn()
+        record('db_pool_wait', time.perf_counter() - started)
+    return g.db_conn
+
+
+def get_read_db(user_id=None):
+    """
+    Return a connection for read-only queries about `user_id`'s data: a
+    replica when one is configured and healthy, otherwise the request's
+    primary connection. Like get_db(), it is reused until teardown.
+    """
+    if 'read_db' in g:
+        return g.read_db[1]
+
+    replicas = get_replicas()
+    if replicas is None:
+        return get_db()
+    if user_id is not None:
+        try:
+            if get_shared_backend().get(RECENT_WRITE_KEY.format(user_id)):
+                return get_db()
+        except Exception as e:
+            current_app.logger.warning(f"Read-your-writes check failed, reading from the primary: {e}")
+            return get_db()
+
+    started = time.perf_counter()
+    pool, conn = replicas.getconn()
+    record('db_pool_wait', time.perf_counter() - started)
+    if conn is None:
+        return get_db()
+    g.read_db = (pool, conn)
+    return conn
+
+
+def reading_from_replica():
+    """True if this request's reads have gone to a replica."""
+    return 'read_db' in g
+
+
+def release_db(exc=None):
+    """Return the request's connections to their pools, rolling back uncommitted work."""
+    conn = g.pop('db_conn', None)
+    if conn is not None:
+        get_pool().putconn(conn)
+    read = g.pop('read_db', None)
+    if read is not None:
+        read[0].putconn(read[1])
+
+
+def init_app(app):
+    """Attach the pool to the Flask app and close it when the process exits."""
+    app.extensions['db_pool'] = get_pool
+    app.teardown_appcontext(release_db)
+    atexit.register(close_pool)
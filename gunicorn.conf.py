@@ -0,0 +1,44 @@
+"""
+gunicorn settings (`gunicorn -c gunicorn.conf.py app:app`).
+
+By default each worker is a plain sync worker that handles one request at a
+time. Setting WEB_WORKER_CLASS=gevent runs every worker as a gevent event
+loop instead: requests become greenlets, and psycopg2 is made cooperative
+(via psycogreen) so that a request waiting on Postgres or the network yields
+to the others. A single process can then keep hundreds of mobile API
+requests in flight, while the views, blueprints and connection pool stay
+exactly as they are.
+
+    WEB_WORKER_CLASS    sync | gevent            (default: sync)
+    WEB_CONCURRENCY     worker processes         (default: 2)
+    WEB_CONNECTIONS     greenlets per gevent worker (default: 500)
+    WEB_TIMEOUT         seconds before a stuck worker is restarted (default: 30)
+
+With gevent workers, DB_POOL_MAX_SIZE bounds the queries actually running
+per process; other requests wait on the pool (up to DB_POOL_TIMEOUT) without
+blocking the worker.
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv('WEB_CONCURRENCY', '2'))
+worker_class = os.getenv('WEB_WORKER_CLASS', 'sync')
+worker_connections = int(os.getenv('WEB_CONNECTIONS', '500'))
+timeout = int(os.getenv('WEB_TIMEOUT', '30'))
+keepalive = 5
+
+
+def post_fork(server, worker):
+    if worker_class == 'gevent':
+        # gunicorn has already monkey-patched the stdlib; psycopg2 is a C
+        # extension and needs its own wait callback to yield while blocked.
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+        server.log.info("Worker %s: psycopg2 patched for gevent", worker.pid)
+
+
+def worker_exit(server, worker):
+    # Commit whatever the write-behind ingestion queue still holds
+    from ingest import drain
+    drain()
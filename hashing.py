@@ -0,0 +1,164 @@
+"""
+Password hashing off the request path.
+
+Hashing and verifying passwords is deliberately slow. Run inline, a burst of
+logins would hold every worker thread and starve cheap requests, so the
+work goes to a small dedicated thread pool instead (hashlib's scrypt and
+pbkdf2 release the GIL while they run). The pool accepts a bounded number
+of jobs; past that, callers get HashPoolBusy immediately and should answer
+503 with a Retry-After header rather than queue up.
+"""
+
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+from config import (
+    PASSWORD_HASH_METHOD,
+    PASSWORD_HASH_WORKERS,
+    PASSWORD_HASH_QUEUE_SIZE,
+    PASSWORD_HASH_TIMEOUT,
+)
+from instrumentation import record
+
+# Seconds clients are told to wait after a HashPoolBusy
+RETRY_AFTER = 1
+
+
+class HashPoolBusy(Exception):
+    """Raised when the hashing pool is saturated or a job takes too long."""
+
+
+def _new_executor(workers):
+    try:
+        from gevent import monkey
+        if monkey.is_module_patched('threading'):
+            # Under gevent workers, "threads" are greenlets; hash on real
+            # threads so that the event loop keeps serving other requests.
+            from gevent.threadpool import ThreadPoolExecutor as GeventThreadPoolExecutor
+            return GeventThreadPoolExecutor(max_workers=workers)
+    except ImportError:
+        pass
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+
+
+class PasswordHasher:
+    """Runs password hashes on a bounded thread pool and records its metrics."""
+
+    def __init__(self, method, workers, queue_size, timeout):
+        self.method = method
+        self.workers = workers
+        self.queue_size = queue_size
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._executor = None
+        self._executor_pid = None
+        self._pending = 0   # queued + running
+        self._running = 0
+        self._latencies = deque(maxlen=1024)  # seconds spent hashing, most recent jobs
+
+        self.completed = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.max_wait = 0.0
+
+    def _get_executor(self):
+        # Threads don't survive a fork, so each worker process builds its own
+        pid = os.getpid()
+        with self._lock:
+            if self._executor is None or self._executor_pid != pid:
+                self._executor = _new_executor(self.workers)
+                self._executor_pid = pid
+                self._pending = 0
+                self._running = 0
+            return self._executor
+
+    def _run(self, func, *args):
+        executor = self._get_executor()
+        with self._lock:
+            if self._pending >= self.workers + self.queue_size:
+                self.rejected += 1
+                raise HashPoolBusy("Password hashing pool is saturated")
+            self._pending += 1
+        submitted = time.monotonic()
+
+        def job():
+            started = time.monotonic()
+            with self._lock:
+                self._running += 1
+                self.max_wait = max(self.max_wait, started - submitted)
+            try:
+                return func(*args)
+            finally:
+                # The job holds its slot until it actually finishes, even if
+                # the caller gave up waiting for it
+                with self._lock:
+                    self._running -= 1
+                    self._pending -= 1
+                    self.completed += 1
+                    self._latencies.append(time.monotonic() - started)
+
+        try:
+            future = executor.submit(job)
+        except Exception:
+            with self._lock:
+                self._pending -= 1
+            raise
+
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeout:
+            with self._lock:
+                self.timeouts += 1
+            raise HashPoolBusy(f"Password hashing took longer than {self.timeout}s")
+        finally:
+            # Includes the queue wait, which is what the request actually paid
+            record('password_hash', time.monotonic() - submitted)
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def stats(self):
+        """Return a snapshot of the pool metrics (latencies in seconds)."""
+        with self._lock:
+            latencies = sorted(self._latencies)
+            running = self._running
+            stats = {
+                'workers': self.workers,
+                'queue_size': self.queue_size,
+                'running': running,
+                'queue_depth': self._pending - running,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'timeouts': self.timeouts,
+                'max_wait': self.max_wait,
+            }
+        for name, q in (('latency_p50', 0.50), ('latency_p95', 0.95), ('latency_max', 1.0)):
+            stats[name] = latencies[min(len(latencies) - 1, int(q * len(latencies)))] if latencies else 0.0
+        return stats
+
+
+password_hasher = PasswordHasher(
+    PASSWORD_HASH_METHOD,
+    PASSWORD_HASH_WORKERS,
+    PASSWORD_HASH_QUEUE_SIZE,
+    PASSWORD_HASH_TIMEOUT,
+)
+
+
+def hash_password(password):
+    """Hash a password with the configured method. Raises HashPoolBusy."""
+    return password_hasher.hash(password)
+
+
+def verify_password(pwhash, password):
+    """Check a password against its stored hash. Raises HashPoolBusy."""
+    return password_hasher.verify(pwhash, password)
@@ -0,0 +1,264 @@
+"""
+Write-behind ingestion of new log entries.
+
+With INGEST_MODE=sync (the default) each entry is inserted and committed by
+the request that receives it. The other modes hand entries to a per-process
+queue instead, and a background writer inserts them in batches of up to
+INGEST_BATCH_SIZE, waiting at most INGEST_FLUSH_INTERVAL seconds for a batch
+to fill, with one multi-row INSERT and one commit per batch:
+
+    flush    the request returns once its batch is committed (durable ack),
+             or reports the entry as pending if that takes longer than
+             INGEST_ACK_TIMEOUT; it stays queued and may still be saved
+    enqueue  the request returns as soon as the entry is queued; entries
+             still queued are lost if the process dies without draining
+
+A batch that fails for a transient reason is retried with backoff; one whose
+data is rejected is written entry by entry, so only the offending entries
+fail (in flush mode, only their requests get an error).
+
+The queue is drained when the worker exits (gunicorn's worker_exit hook, or
+atexit otherwise).
+"""
+
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+import psycopg2
+
+from config import (
+    INGEST_MODE,
+    INGEST_BATCH_SIZE,
+    INGEST_FLUSH_INTERVAL,
+    INGEST_QUEUE_MAX,
+    INGEST_ACK_TIMEOUT,
+)
+from db import get_pool
+from instrumentation import record
+from models import insert_logs, invalidate_user_data, notify_logs_inserted
+
+logger = logging.getLogger(__name__)
+
+INGEST_MODES = ('sync', 'flush', 'enqueue')
+
+# Seconds to wait before each retry of a batch that failed for reasons other
+# than its data (connection loss, failover)
+FLUSH_RETRY_DELAYS = (0.25, 0.5, 1.0)
+if INGEST_MODE not in INGEST_MODES:
+    raise RuntimeError(f"INGEST_MODE must be one of: {', '.join(INGEST_MODES)}")
+
+
+class IngestQueueFull(Exception):
+    """Raised when the queue is at capacity or shutting down."""
+
+
+class IngestError(Exception):
+    """Raised in flush mode when the entry's batch failed."""
+
+
+class IngestPending(Exception):
+    """Raised in flush mode when the entry is still queued or being written after the ack timeout."""
+
+
+class _Ack:
+    __slots__ = ('event', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.error = None
+
+
+class IngestQueue:
+    """A bounded queue of (user_id, log_time) entries written by one background thread."""
+
+    def __init__(self, batch_size, flush_interval, max_size, ack_timeout):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.ack_timeout = ack_timeout
+
+        self._cond = threading.Condition()
+        self._items = deque()  # (user_id, log_time, _Ack or None)
+        self._writer = None
+        self._writer_pid = None
+        self._stopping = False
+        self._flush_latencies = deque(maxlen=1024)
+
+        self.enqueued = 0
+        self.written = 0
+        self.failed = 0
+        self.rejected = 0
+        self.batches = 0
+        self.last_batch_size = 0
+
+    def _ensure_writer(self):
+        # Called with the condition held. Threads don't survive a fork, so
+        # each worker process starts its own writer.
+        pid = os.getpid()
+        if self._writer is None or self._writer_pid != pid:
+            self._items.clear()
+            self._stopping = False
+            self._writer = threading.Thread(target=self._run, name='ingest-writer', daemon=True)
+            self._writer_pid = pid
+            self._writer.start()
+
+    def submit(self, user_id, log_time, wait):
+        """Queue an entry; with `wait`, block until its batch is committed."""
+        ack = _Ack() if wait else None
+        with self._cond:
+            self._ensure_writer()
+            if self._stopping:
+                raise IngestQueueFull("Ingestion queue is shutting down")
+            if len(self._items) >= self.max_size:
+                self.rejected += 1
+                raise IngestQueueFull("Ingestion queue is full")
+            self._items.append((user_id, log_time, ack))
+            self.enqueued += 1
+            self._cond.notify()
+
+        if ack is not None:
+            started = time.monotonic()
+            committed = ack.event.wait(self.ack_timeout)
+            record('ingest_wait', time.monotonic() - started)
+            if not committed:
+                raise IngestPending(f"Entry not committed within {self.ack_timeout}s")
+            if ack.error:
+                raise IngestError(ack.error)
+
+    def _take_batch(self):
+        """Wait for entries and return the next batch, or None once stopped and empty."""
+        with self._cond:
+            while not self._items and not self._stopping:
+                self._cond.wait()
+            if not self._items:
+                return None
+            # Give the batch a moment to fill before writing it
+            deadline = time.monotonic() + self.flush_interval
+            while len(self._items) < self.batch_size and not self._stopping:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return [self._items.popleft() for _ in range(min(self.batch_size, len(self._items)))]
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if batch is None:
+                return
+            self._flush(batch)
+
+    def _write(self, entries):
+        """Insert and commit (user_id, log_time) entries in one transaction."""
+        with get_pool().connection() as conn:
+            cursor = conn.cursor()
+            rows = insert_logs(cursor, entries)
+            notify_logs_inserted(cursor, rows)
+            conn.commit()
+
+    def _write_batch(self, entries):
+        """
+        Write a batch, retrying transient failures with backoff. If the data
+        itself is rejected (e.g. a user deleted meanwhile), write the entries
+        one by one so only the offending ones fail.
+        Returns one error (or None) per entry.
+        """
+        for attempt in range(len(FLUSH_RETRY_DELAYS) + 1):
+            try:
+                self._write(entries)
+                return [None] * len(entries)
+            except (psycopg2.IntegrityError, psycopg2.DataError) as e:
+                if len(entries) == 1:
+                    return [e]
+                logger.warning("Ingestion batch of %d entries rejected, writing them one by one: %s",
+                               len(entries), e)
+                return [self._write_batch([entry])[0] for entry in entries]
+            except Exception as e:
+                if attempt == len(FLUSH_RETRY_DELAYS):
+                    return [e] * len(entries)
+                logger.warning("Ingestion flush of %d entries failed, retrying in %ss: %s",
+                               len(entries), FLUSH_RETRY_DELAYS[attempt], e)
+                time.sleep(FLUSH_RETRY_DELAYS[attempt])
+
+    def _flush(self, batch):
+        started = time.monotonic()
+        errors = self._write_batch([(user_id, log_time) for user_id, log_time, _ in batch])
+        elapsed = time.monotonic() - started
+        record('ingest_flush', elapsed)
+
+        failed = sum(1 for error in errors if error is not None)
+        if failed:
+            logger.error("Ingestion lost %d of %d entries: %s", failed, len(batch),
+                         next(error for error in errors if error is not None))
+        with self._cond:
+            self.batches += 1
+            self.last_batch_size = len(batch)
+            self._flush_latencies.append(elapsed)
+            self.written += len(batch) - failed
+            self.failed += failed
+
+        for user_id in {user_id for (user_id, _, _), error in zip(batch, errors) if error is None}:
+            try:
+                invalidate_user_data(user_id)
+            except Exception as e:
+                logger.warning("Could not invalidate cached pages for user %s: %s", user_id, e)
+
+        for (_, _, ack), error in zip(batch, errors):
+            if ack is not None:
+                ack.error = None if error is None else f"Could not save entry: {error}"
+                ack.event.set()
+
+    def drain(self, timeout=30):
+        """Stop accepting entries and wait for the writer to flush what is queued."""
+        with self._cond:
+            writer = self._writer if self._writer_pid == os.getpid() else None
+            self._stopping = True
+            self._cond.notify_all()
+        if writer is not None:
+            writer.join(timeout)
+            if writer.is_alive():
+                logger.error("Ingestion queue not drained after %ss; %d entries lost", timeout, len(self._items))
+
+    def stats(self):
+        """Return a snapshot of the queue metrics (latencies in seconds)."""
+        with self._cond:
+            latencies = sorted(self._flush_latencies)
+            stats = {
+                'queue_depth': len(self._items),
+                'max_size': self.max_size,
+                'enqueued': self.enqueued,
+                'written': self.written,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'batches': self.batches,
+                'last_batch_size': self.last_batch_size,
+            }
+        for name, q in (('flush_p50', 0.50), ('flush_p95', 0.95), ('flush_max', 1.0)):
+            stats[name] = latencies[min(len(latencies) - 1, int(q * len(latencies)))] if latencies else 0.0
+        return stats
+
+
+ingest_queue = IngestQueue(INGEST_BATCH_SIZE, INGEST_FLUSH_INTERVAL, INGEST_QUEUE_MAX, INGEST_ACK_TIMEOUT)
+
+
+def ingest_enabled():
+    return INGEST_MODE != 'sync'
+
+
+def submit_log(user_id, log_time):
+    """Queue a log entry; in flush mode, return only once it is committed."""
+    ingest_queue.submit(user_id, log_time, wait=INGEST_MODE == 'flush')
+
+
+def drain(timeout=30):
+    ingest_queue.drain(timeout)
+
+
+def init_app(app):
+    # Registered after db.init_app, so that at exit (run in reverse order)
+    # the queue is flushed before the connection pool closes
+    atexit.register(drain)
@@ -0,0 +1,292 @@
+"""
+Request timing and SQL instrumentation.
+
+Every request records how long it spent in the database (connects, pool
+waits, queries), hashing passwords and rendering templates. The breakdown is
+returned in a Server-Timing header, and per-process totals are exported in
+Prometheus text format at /metrics. Queries slower than SLOW_QUERY_LOG_MS
+are logged when that setting is non-zero.
+
+/metrics reports only the worker process that answers the scrape, and
+nothing aggregates across workers: every series carries a `worker` label
+(the process id) so that each worker's counters stay distinct and their
+resets on restart are visible. Sum over `worker` for totals, bearing in
+mind that a scrape reaches one worker at a time, so with several workers
+some series are older than others.
+
+Queries are timed by InstrumentedCursor, the cursor class of every
+connection opened by db.connect(); other code reports timings with record().
+"""
+
+import logging
+import os
+import threading
+import time
+
+import psycopg2.extensions
+from flask import g, request, current_app, has_request_context, template_rendered, before_render_template
+
+from config import SLOW_QUERY_LOG_MS, METRICS_TOKEN
+
+logger = logging.getLogger(__name__)
+
+# Timed operations, in Server-Timing order: key -> Server-Timing name
+OPERATIONS = {
+    'db_connect': 'db-connect',
+    'db_pool_wait': 'db-pool',
+    'db_query': 'db',
+    'password_hash': 'hash',
+    'template_render': 'render',
+    'ingest_wait': 'ingest',
+}
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """A labelled Prometheus-style histogram of durations in seconds."""
+
+    def __init__(self, name, help, labelnames, buckets=DURATION_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._series = {}  # label values -> [bucket counts..., count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted(self._series.items())
+            items = [(labels, list(series)) for labels, series in items]
+        for labels, series in items:
+            base = _format_labels(self.labelnames, labels)
+            for bound, count in zip(self.buckets, series):
+                lines.append(f'{self.name}_bucket{_add_label(base, "le", bound)} {count}')
+            lines.append(f'{self.name}_bucket{_add_label(base, "le", "+Inf")} {series[-2]}')
+            lines.append(f"{self.name}_count{base} {series[-2]}")
+            lines.append(f"{self.name}_sum{base} {series[-1]:.6f}")
+        return lines
+
+
+class Counter:
+    """A labelled Prometheus-style counter."""
+
+    def __init__(self, name, help, labelnames):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + '}'
+
+
+def _add_label(base, name, value):
+    label = f'{name}="{value}"'
+    return '{' + (base[1:-1] + ',' if base else '') + label + '}'
+
+
+request_duration = Histogram(
+    'http_request_duration_seconds', 'Time spent handling requests.', ('endpoint', 'method', 'status'))
+operation_duration = Histogram(
+    'app_operation_duration_seconds', 'Time spent in database, hashing and rendering operations.', ('operation',))
+request_queries = Counter(
+    'http_request_db_queries_total', 'Database queries run, by endpoint.', ('endpoint',))
+request_rows = Counter(
+    'http_request_db_rows_total', 'Rows returned or affected by queries, by endpoint.', ('endpoint',))
+request_connects = Counter(
+    'http_request_db_connects_total', 'New database connections opened, by endpoint.', ('endpoint',))
+
+
+def _request_stats():
+    """Per-request accumulators, or None outside a request."""
+    if not has_request_context():
+        return None
+    stats = g.get('_instrumentation')
+    if stats is None:
+        stats = g._instrumentation = {'timings': {}, 'rows': 0}
+    return stats
+
+
+def record(operation, seconds, rows=0):
+    """
+    Record one timed operation for the current request, if any, and the
+    process totals. Operations outside OPERATIONS (e.g. background work)
+    only appear in the totals.
+    """
+    operation_duration.observe((operation,), seconds)
+    stats = _request_stats()
+    if stats is not None:
+        total, count = stats['timings'].get(operation, (0.0, 0))
+        stats['timings'][operation] = (total + seconds, count + 1)
+        stats['rows'] += rows
+
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    """A cursor that times its queries and counts the rows they return."""
+
+    def _timed(self, method, query, vars):
+        started = time.perf_counter()
+        try:
+            return method(query, vars)
+        finally:
+            elapsed = time.perf_counter() - started
+            record('db_query', elapsed, max(self.rowcount, 0))
+            if SLOW_QUERY_LOG_MS and elapsed * 1000 >= SLOW_QUERY_LOG_MS:
+                sql = self.query.decode('utf-8', 'replace') if self.query else str(query)
+                logger.warning("Slow query (%.1f ms): %s", elapsed * 1000, ' '.join(sql.split())[:2000])
+
+    def execute(self, query, vars=None):
+        return self._timed(super().execute, query, vars)
+
+    def executemany(self, query, vars_list):
+        return self._timed(super().executemany, query, vars_list)
+
+
+def _before_request():
+    g._request_started = time.perf_counter()
+
+
+def _before_render(sender, template, context, **extra):
+    if has_request_context():
+        g._render_started = time.perf_counter()
+
+
+def _rendered(sender, template, context, **extra):
+    if has_request_context() and '_render_started' in g:
+        record('template_render', time.perf_counter() - g.pop('_render_started'))
+
+
+def _after_request(response):
+    started = g.get('_request_started')
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    endpoint = request.endpoint or 'unmatched'
+    request_duration.observe((endpoint, request.method, str(response.status_code)), elapsed)
+
+    stats = _request_stats()
+    timings = stats['timings']
+    queries = timings.get('db_query', (0.0, 0))[1]
+    request_queries.inc((endpoint,), queries)
+    request_rows.inc((endpoint,), stats['rows'])
+    request_connects.inc((endpoint,), timings.get('db_connect', (0.0, 0))[1])
+
+    parts = [f"app;dur={elapsed * 1000:.1f}"]
+    for operation, name in OPERATIONS.items():
+        if operation in timings:
+            total, count = timings[operation]
+            parts.append(f'{name};dur={total * 1000:.1f};desc="{count}x"')
+    response.headers.add('Server-Timing', ', '.join(parts))
+    return response
+
+
+def _gauge(name, help, values, labelname=None):
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} gauge"]
+    for label, value in values:
+        lines.append(f'{name}{{{labelname}="{_escape(label)}"}} {value}' if labelname else f"{name} {value}")
+    return lines
+
+
+def _add_worker_label(line, worker):
+    if line.startswith('#'):
+        return line
+    name, rest = line.rsplit(' ', 1)
+    if name.endswith('}'):
+        return f'{name[:-1]},worker="{worker}"}} {rest}'
+    return f'{name}{{worker="{worker}"}} {rest}'
+
+
+def render_metrics(app):
+    """Return this process's metrics in Prometheus text format, labelled with its worker."""
+    # Imported here: these modules report into this one
+    from api_auth import credential_cache
+    from db import get_replicas
+    from hashing import password_hasher
+    from ingest import ingest_queue
+    from live import live_hub
+    from models import _public_users_cache, _user_cache
+    from ratelimit import get_limiter
+
+    lines = []
+    for metric in (request_duration, operation_duration, request_queries, request_rows, request_connects):
+        lines.extend(metric.render())
+
+    pool = app.extensions['db_pool']().stats()
+    lines.extend(_gauge('db_pool', 'Connection pool state and lifetime counters.', pool.items(), 'stat'))
+    hasher = password_hasher.stats()
+    lines.extend(_gauge('password_hash_pool', 'Password hashing pool state and latency (seconds).',
+                        hasher.items(), 'stat'))
+    replicas = get_replicas()
+    if replicas is not None:
+        lines.extend(_gauge('db_replica_pool', 'Read replica pool state, by replica and stat.', [], 'replica'))
+        for index, stats in enumerate(replicas.stats()):
+            lines.extend(f'db_replica_pool{{replica="{index}",stat="{_escape(stat)}"}} {value}'
+                         for stat, value in stats.items())
+        lines.extend(_gauge('db_replica_fallbacks', 'Replica reads served by the primary.',
+                            [(None, replicas.fallbacks)]))
+
+    lines.extend(_gauge('ingest_queue', 'Write-behind ingestion queue state and flush latency (seconds).',
+                        ingest_queue.stats().items(), 'stat'))
+    lines.extend(_gauge('live_updates', 'Live update subscribers and listener state.',
+                        live_hub.stats().items(), 'stat'))
+
+    caches = (('credentials', credential_cache), ('public_users', _public_users_cache), ('users', _user_cache))
+    for stat in ('size', 'hits', 'misses'):
+        lines.extend(_gauge(f'cache_{stat}', f'In-process cache {stat}.',
+                            [(name, cache.stats()[stat]) for name, cache in caches], 'cache'))
+
+    lines.extend(_gauge('ratelimit_rejected', 'Requests rejected by rate limit rule.',
+                        sorted(get_limiter().rejected.items()), 'rule'))
+    worker = os.getpid()
+    return '\n'.join(_add_worker_label(line, worker) for line in lines) + '\n'
+
+
+def metrics():
+    """Prometheus scrape endpoint; needs METRICS_TOKEN as a Bearer token, or a local client if unset."""
+    if METRICS_TOKEN:
+        if request.headers.get('Authorization', '') != f'Bearer {METRICS_TOKEN}':
+            return 'Unauthorized', 401
+    elif request.remote_addr not in ('127.0.0.1', '::1'):
+        return 'Not found', 404
+    return render_metrics(current_app), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+def init_app(app):
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_rendered, app)
+    app.add_url_rule('/metrics', 'metrics', metrics)
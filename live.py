@@ -0,0 +1,237 @@
+"""
+Live dashboard updates over Server-Sent Events.
+
+Writes to poop send a Postgres NOTIFY on the poop_changes channel (see
+models.notify_log_changes), delivered when they commit. Each process keeps
+one LISTEN connection, on a background thread, and fans the notifications
+out to the streams watching that user, so an idle subscriber costs a queue
+rather than a database connection:
+
+    GET /events?user_id=N               dashboard (session login)
+    GET /api/events?view_user_id=N      mobile app (Bearer token)
+
+Streams carry two kinds of events:
+
+    log      {"user_id", "inserted": [{"id", "log_time"}], "deleted": [ids]}
+    resync   events may have been missed (slow client, listener reconnect,
+             or a change too large for one notification); refetch
+
+A stream ends after LIVE_MAX_DURATION seconds and the client reconnects
+(EventSource does so on its own); it should refetch then too. Streams hold
+their request open, so this needs gevent workers (see gunicorn.conf.py).
+"""
+
+import json
+import logging
+import os
+import queue
+import select
+import threading
+import time
+
+from flask import Response
+
+from config import LIVE_HEARTBEAT, LIVE_MAX_DURATION, LIVE_QUEUE_SIZE
+from db import connect
+from models import LOG_CHANGES_CHANNEL, get_public_users
+
+logger = logging.getLogger(__name__)
+
+# Seconds between attempts to reopen a lost LISTEN connection
+RECONNECT_DELAY = 5
+# With nothing to deliver, the listener checks its connection this often
+LISTEN_IDLE_CHECK = 60
+# Sent to clients as the EventSource reconnection delay
+CLIENT_RETRY_MS = 3000
+
+RESYNC = ('resync', '{}')
+
+
+class Subscription:
+    """One stream's queue of (event, data) pairs for one user."""
+
+    def __init__(self, hub, user_id, max_size):
+        self.hub = hub
+        self.user_id = user_id
+        self._events = queue.Queue(max_size)
+
+    def push(self, event):
+        # Only the listener thread pushes, so nothing refills the queue in between
+        try:
+            self._events.put_nowait(event)
+        except queue.Full:
+            # The client refetches on resync, so what's buffered can go
+            while True:
+                try:
+                    self._events.get_nowait()
+                except queue.Empty:
+                    break
+            self._events.put_nowait(RESYNC)
+            self.hub.resyncs += 1
+
+    def get(self, timeout):
+        """Return the next event, or None if none arrived within `timeout` seconds."""
+        try:
+            return self._events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+
+class LiveHub:
+    """Per-process LISTEN connection and the subscriptions it feeds."""
+
+    def __init__(self, channel, queue_size):
+        self.channel = channel
+        self.queue_size = queue_size
+
+        self._lock = threading.Lock()
+        self._subscribers = {}  # user_id -> set of Subscription
+        self._listener = None
+        self._listener_pid = None
+        self.connected = False
+
+        self.notifications = 0
+        self.resyncs = 0
+        self.reconnects = 0
+
+    def _ensure_listener(self):
+        # Called with the lock held. Threads don't survive a fork, so each
+        # worker process starts its own listener.
+        pid = os.getpid()
+        if self._listener is None or self._listener_pid != pid:
+            self._subscribers = {}
+            self.connected = False
+            self._listener = threading.Thread(target=self._run, name='live-listener', daemon=True)
+            self._listener_pid = pid
+            self._listener.start()
+
+    def subscribe(self, user_id):
+        subscription = Subscription(self, user_id, self.queue_size)
+        with self._lock:
+            self._ensure_listener()
+            self._subscribers.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.user_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.user_id]
+
+    def _deliver(self, user_id, event):
+        with self._lock:
+            subscribers = list(self._subscribers.get(user_id, ()))
+        for subscription in subscribers:
+            subscription.push(event)
+
+    def _dispatch(self, payload):
+        self.notifications += 1
+        try:
+            change = json.loads(payload)
+            user_id = change['user_id']
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning("Ignoring malformed %s notification: %s", self.channel, e)
+            return
+        self._deliver(user_id, RESYNC if change.get('resync') else ('log', payload))
+
+    def _broadcast(self, event):
+        with self._lock:
+            subscribers = [s for group in self._subscribers.values() for s in group]
+        for subscription in subscribers:
+            subscription.push(event)
+
+    def _run(self):
+        first = True
+        while True:
+            conn = None
+            try:
+                conn = connect()
+                conn.autocommit = True
+                conn.cursor().execute(f"LISTEN {self.channel}")
+                self.connected = True
+                if not first:
+                    # Anything committed while disconnected was never delivered
+                    self.reconnects += 1
+                    self._broadcast(RESYNC)
+                first = False
+                self._listen(conn)
+            except Exception as e:
+                logger.error("Live updates listener failed, reconnecting in %ss: %s", RECONNECT_DELAY, e)
+            finally:
+                self.connected = False
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+            time.sleep(RECONNECT_DELAY)
+
+    def _listen(self, conn):
+        while True:
+            if select.select([conn], [], [], LISTEN_IDLE_CHECK) == ([], [], []):
+                # Quiet for a while; a query fails fast if the connection is gone
+                conn.cursor().execute("SELECT 1")
+            else:
+                conn.poll()
+            while conn.notifies:
+                self._dispatch(conn.notifies.pop(0).payload)
+
+    def stats(self):
+        with self._lock:
+            users = len(self._subscribers)
+            subscribers = sum(len(group) for group in self._subscribers.values())
+        return {
+            'subscribers': subscribers,
+            'users': users,
+            'connected': int(self.connected),
+            'notifications': self.notifications,
+            'resyncs': self.resyncs,
+            'reconnects': self.reconnects,
+        }
+
+
+live_hub = LiveHub(LOG_CHANGES_CHANNEL, LIVE_QUEUE_SIZE)
+
+
+def can_watch(user_id, viewer_id=None):
+    """Whether a viewer (None when anonymous) may follow a user's dashboard."""
+    if viewer_id is not None and user_id == viewer_id:
+        return True
+    return any(user[0] == user_id for user in get_public_users())
+
+
+def event_stream(user_id):
+    """A text/event-stream response with the user's changes, until LIVE_MAX_DURATION."""
+    def generate():
+        # Subscribing inside the generator means a stream the server never
+        # starts (client already gone) leaves nothing behind
+        subscription = live_hub.subscribe(user_id)
+        try:
+            yield f"retry: {CLIENT_RETRY_MS}\n\n"
+            deadline = time.monotonic() + LIVE_MAX_DURATION
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                event = subscription.get(min(LIVE_HEARTBEAT, remaining))
+                if event is None:
+                    # Keeps proxies from timing out the idle stream, and
+                    # surfaces a disconnected client as a write error
+                    yield ": keepalive\n\n"
+                else:
+                    name, data = event
+                    yield f"event: {name}\ndata: {data}\n\n"
+        finally:
+            subscription.close()
+
+    response = Response(generate(), mimetype='text/event-stream')
+    response.cache_control.no_cache = True
+    response.cache_control.private = True
+    # Stop nginx-style proxies from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
@@ -0,0 +1,332 @@
+"""
+Versioned schema migrations.
+
+Migrations are the SQL files in migrations/, applied in filename order and
+recorded in the schema_migrations table. Each file runs in its own
+transaction unless its first line is `-- migrate: no-transaction` (needed for
+CREATE INDEX CONCURRENTLY), in which case its statements run one by one.
+
+    python migrate.py upgrade
+    python migrate.py status
+    python migrate.py check
+
+poop is range-partitioned by month. Migration 0006 creates the partitioned
+copy; `python migrate.py partition-poop` then copies the existing entries
+into it in batches while the app keeps running, and swaps it in.
+`python migrate.py partitions` creates the coming months' partitions; it runs
+on every upgrade and should also run daily (e.g. from a scheduler).
+
+Migrations run in the release phase, before the new code serves traffic,
+so data they derive from writes can miss what the previous release writes
+meanwhile. After deploying a release containing 0003, once it is live on
+every dyno, rebuild the rollup:
+
+    heroku run flask --app app rollup rebuild
+
+This runs without importing the app, whose startup check would otherwise
+refuse to load before the indexes exist.
+"""
+
+import os
+import sys
+import time
+
+import click
+
+from config import POOP_PARTITION_MONTHS_AHEAD, POOP_PARTITION_BATCH_SIZE
+from db import connect
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+NO_TRANSACTION_MARKER = '-- migrate: no-transaction'
+
+# Arbitrary key for pg_advisory_lock, so concurrent deploys don't race
+MIGRATION_LOCK_ID = 781_206_001
+
+# Indexes the hot queries depend on; the app refuses to start without them
+REQUIRED_INDEXES = (
+    'users_email_idx',
+    'users_public_idx',
+    'poop_user_id_log_time_idx',
+    'poop_user_id_id_idx',
+    'poop_tombstones_user_id_idx',
+    'poop_user_id_idempotency_key_idx',
+)
+
+
+@click.group(help='Manage the database schema.')
+def migrate_cli():
+    pass
+
+
+def available_migrations():
+    """Return (version, path) for every migration file, in order."""
+    names = sorted(n for n in os.listdir(MIGRATIONS_DIR) if n.endswith('.sql'))
+    return [(name[:-len('.sql')], os.path.join(MIGRATIONS_DIR, name)) for name in names]
+
+
+def applied_migrations(conn):
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version TEXT PRIMARY KEY,
+            applied_at TIMESTAMP NOT NULL DEFAULT NOW()
+        )
+        """
+    )
+    conn.commit()
+    cursor.execute("SELECT version FROM schema_migrations")
+    return {row[0] for row in cursor.fetchall()}
+
+
+def _split_statements(sql):
+    return [s.strip() for s in sql.split(';\n') if s.strip().rstrip(';').strip()]
+
+
+def apply_migration(conn, version, path):
+    with open(path, encoding='utf-8') as f:
+        sql = f.read()
+
+    cursor = conn.cursor()
+    if sql.startswith(NO_TRANSACTION_MARKER):
+        conn.autocommit = True
+        try:
+            for statement in _split_statements(sql):
+                cursor.execute(statement)
+        finally:
+            conn.autocommit = False
+        cursor.execute("INSERT INTO schema_migrations (version) VALUES (%s)", (version,))
+    else:
+        cursor.execute(sql)
+        cursor.execute("INSERT INTO schema_migrations (version) VALUES (%s)", (version,))
+    conn.commit()
+
+
+def upgrade(conn, echo=print):
+    """Apply every pending migration. Returns the versions applied."""
+    cursor = conn.cursor()
+    conn.autocommit = True
+    cursor.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+    conn.autocommit = False
+    try:
+        done = applied_migrations(conn)
+        applied = []
+        for version, path in available_migrations():
+            if version in done:
+                continue
+            echo(f"Applying {version}...")
+            apply_migration(conn, version, path)
+            applied.append(version)
+        return applied
+    finally:
+        conn.rollback()
+        conn.autocommit = True
+        cursor.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+        conn.autocommit = False
+
+
+def missing_indexes(conn):
+    """Return the required indexes that are absent or not valid (e.g. a failed CONCURRENTLY build)."""
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        SELECT c.relname
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = current_schema() AND i.indisvalid AND c.relname = ANY(%s)
+        """,
+        (list(REQUIRED_INDEXES),)
+    )
+    present = {row[0] for row in cursor.fetchall()}
+    conn.rollback()
+    return [name for name in REQUIRED_INDEXES if name not in present]
+
+
+def check_required_indexes():
+    """Raise RuntimeError when the schema is missing any required index."""
+    conn = connect()
+    try:
+        missing = missing_indexes(conn)
+    finally:
+        conn.close()
+    if missing:
+        raise RuntimeError(
+            f"Missing required database indexes: {', '.join(missing)}. Run `python migrate.py upgrade`."
+        )
+
+
+def partitioned_poop_table(conn):
+    """Return the name of the partitioned poop table (before or after the swap), or None."""
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        SELECT relname FROM pg_class
+        WHERE relnamespace = current_schema()::regnamespace AND relkind = 'p'
+          AND relname IN ('poop', 'poop_partitioned')
+        """
+    )
+    row = cursor.fetchone()
+    conn.rollback()
+    return row[0] if row else None
+
+
+def create_partitions(conn, months_ahead=POOP_PARTITION_MONTHS_AHEAD):
+    """Create the monthly partitions up to `months_ahead` months from now. Returns how many were created."""
+    table = partitioned_poop_table(conn)
+    if table is None:
+        return 0
+    cursor = conn.cursor()
+    cursor.execute("SELECT create_poop_partitions(%s, %s)", (table, months_ahead))
+    created = cursor.fetchone()[0]
+    conn.commit()
+    return created
+
+
+def backfill_partitioned_poop(conn, batch_size=POOP_PARTITION_BATCH_SIZE, pause=0, echo=print):
+    """
+    Copy the entries that predate migration 0006 into poop_partitioned, in
+    id order, one committed batch at a time; it resumes where it stopped.
+    """
+    cursor = conn.cursor()
+    cursor.execute("SELECT high, done FROM poop_partition_backfill")
+    high, done = cursor.fetchone()
+    conn.commit()
+    while done < high:
+        end = min(done + batch_size, high)
+        # FOR SHARE makes a concurrent delete wait for this batch, so its
+        # mirror trigger then removes the copy instead of missing it
+        cursor.execute(
+            """
+            WITH batch AS (
+                SELECT id, user_id, log_time, idempotency_key FROM poop
+                WHERE id > %(done)s AND id <= %(end)s
+                FOR SHARE
+            )
+            INSERT INTO poop_partitioned (id, user_id, log_time, idempotency_key)
+            SELECT * FROM batch
+            ON CONFLICT DO NOTHING
+            """,
+            {'done': done, 'end': end}
+        )
+        cursor.execute("UPDATE poop_partition_backfill SET done = %s", (end,))
+        conn.commit()
+        done = end
+        echo(f"  copied ids up to {done}/{high}")
+        if pause:
+            time.sleep(pause)
+
+
+def swap_partitioned_poop(conn, echo=print):
+    """
+    Rename poop_partitioned to poop once it holds every entry. The old table
+    is kept as poop_unpartitioned, to be dropped by hand.
+    """
+    cursor = conn.cursor()
+    cursor.execute("SELECT high, done FROM poop_partition_backfill")
+    high, done = cursor.fetchone()
+    if done < high:
+        raise click.ClickException("The backfill hasn't finished.")
+    # One snapshot, and the trigger writes both tables in the same transaction
+    cursor.execute("SELECT (SELECT COUNT(*) FROM poop), (SELECT COUNT(*) FROM poop_partitioned)")
+    old_count, new_count = cursor.fetchone()
+    conn.rollback()
+    if old_count != new_count:
+        raise click.ClickException(f"poop has {old_count} entries but poop_partitioned has {new_count}.")
+
+    echo("Swapping tables...")
+    # Writes queue behind the lock for the few renames below; give up rather
+    # than stall them behind a long-running query
+    cursor.execute("SET LOCAL lock_timeout = '10s'")
+    cursor.execute("LOCK TABLE poop, poop_partitioned IN ACCESS EXCLUSIVE MODE")
+    cursor.execute("DROP TRIGGER poop_mirror_to_partitioned ON poop")
+    cursor.execute("DROP FUNCTION poop_mirror_to_partitioned()")
+    cursor.execute("ALTER TABLE poop RENAME TO poop_unpartitioned")
+    for suffix in ('pkey', 'user_id_log_time_idx', 'user_id_id_idx', 'user_id_idempotency_key_idx'):
+        cursor.execute(f"ALTER INDEX IF EXISTS poop_{suffix} RENAME TO poop_unpartitioned_{suffix}")
+        cursor.execute(f"ALTER INDEX poop_partitioned_{suffix} RENAME TO poop_{suffix}")
+    cursor.execute("ALTER TABLE poop_partitioned RENAME TO poop")
+    # Otherwise dropping the old table would drop the sequence too
+    cursor.execute("ALTER SEQUENCE poop_id_seq OWNED BY poop.id")
+    cursor.execute("DROP TABLE poop_partition_backfill")
+    conn.commit()
+
+
+@migrate_cli.command('upgrade')
+def upgrade_command():
+    """Apply pending migrations and create upcoming partitions."""
+    conn = connect()
+    try:
+        applied = upgrade(conn, echo=click.echo)
+        created = create_partitions(conn)
+    finally:
+        conn.close()
+    click.echo(f"Applied {len(applied)} migration(s)." if applied else "Schema is up to date.")
+    if created:
+        click.echo(f"Created {created} partition(s).")
+
+
+@migrate_cli.command('partitions')
+@click.option('--months-ahead', default=POOP_PARTITION_MONTHS_AHEAD, show_default=True,
+              help='Months past the current one to create partitions for.')
+def partitions_command(months_ahead):
+    """Create the coming months' poop partitions."""
+    conn = connect()
+    try:
+        created = create_partitions(conn, months_ahead)
+    finally:
+        conn.close()
+    click.echo(f"Created {created} partition(s).")
+
+
+@migrate_cli.command('partition-poop')
+@click.option('--batch-size', default=POOP_PARTITION_BATCH_SIZE, show_default=True,
+              help='Ids copied per transaction.')
+@click.option('--pause', default=0.0, show_default=True, help='Seconds to sleep between batches.')
+@click.option('--no-swap', is_flag=True, help='Only copy; swap the tables on a later run.')
+def partition_poop_command(batch_size, pause, no_swap):
+    """Copy poop into its partitioned replacement online, then swap them."""
+    conn = connect()
+    try:
+        table = partitioned_poop_table(conn)
+        if table != 'poop_partitioned':
+            click.echo("poop is already partitioned." if table else "Run `python migrate.py upgrade` first.")
+            return
+        click.echo("Copying entries...")
+        backfill_partitioned_poop(conn, batch_size, pause, echo=click.echo)
+        if no_swap:
+            return
+        swap_partitioned_poop(conn, echo=click.echo)
+    finally:
+        conn.close()
+    click.echo("poop is now partitioned; drop poop_unpartitioned once you no longer need it.")
+
+
+@migrate_cli.command('status')
+def status_command():
+    """List migrations and whether they have been applied."""
+    conn = connect()
+    try:
+        done = applied_migrations(conn)
+    finally:
+        conn.close()
+    for version, _ in available_migrations():
+        click.echo(f"[{'x' if version in done else ' '}] {version}")
+
+
+@migrate_cli.command('check')
+def check_command():
+    """Exit non-zero if any required index is missing."""
+    conn = connect()
+    try:
+        missing = missing_indexes(conn)
+    finally:
+        conn.close()
+    if missing:
+        click.echo(f"Missing indexes: {', '.join(missing)}")
+        raise SystemExit(1)
+    click.echo("All required indexes are present.")
+
+
+if __name__ == '__main__':
+    migrate_cli.main(args=sys.argv[1:], prog_name='migrate.py')
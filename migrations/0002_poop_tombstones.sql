@@ -0,0 +1,15 @@
+-- One row per deleted poop entry, so sync clients can learn about deletions
+--
+-- Dynos on the previous release delete without leaving a tombstone until
+-- they are replaced. Clients only get a watermark from the new release, so
+-- this matters only where both serve at once (preboot); such a client keeps
+-- a deleted entry until its next full sync.
+
+CREATE TABLE IF NOT EXISTS poop_tombstones (
+    id BIGSERIAL PRIMARY KEY,
+    poop_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    deleted_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS poop_tombstones_user_id_idx ON poop_tombstones (user_id, id);
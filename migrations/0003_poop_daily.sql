@@ -0,0 +1,25 @@
+-- Per-user daily rollup of poop, maintained on every insert/delete
+-- (see models.insert_log/delete_log), backfilled from the existing logs
+--
+-- This runs in the release phase, while dynos on the previous release still
+-- serve and write logs without touching the rollup. Once the new release is
+-- live everywhere, run `flask --app app rollup rebuild` to count what they
+-- wrote in between (see migrate.py).
+
+CREATE TABLE IF NOT EXISTS poop_daily (
+    user_id INTEGER NOT NULL,
+    day DATE NOT NULL,
+    count INTEGER NOT NULL,
+    first_time TIMESTAMP NOT NULL,
+    last_time TIMESTAMP NOT NULL,
+    PRIMARY KEY (user_id, day)
+);
+
+LOCK TABLE poop_daily IN EXCLUSIVE MODE;
+
+DELETE FROM poop_daily;
+
+INSERT INTO poop_daily (user_id, day, count, first_time, last_time)
+SELECT user_id, log_time::date, COUNT(*), MIN(log_time), MAX(log_time)
+FROM poop
+GROUP BY 1, 2;
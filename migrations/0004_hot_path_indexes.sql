@@ -0,0 +1,15 @@
+-- migrate: no-transaction
+-- Indexes behind the hot queries, built without blocking writes.
+
+-- Login and API credential lookups. 0001 adopts an existing users table as
+-- is, which may lack the UNIQUE constraint on email and the index behind it.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS users_email_idx ON users (email);
+
+-- Log listing, keyset pagination and the last-entry lookup
+CREATE INDEX CONCURRENTLY IF NOT EXISTS poop_user_id_log_time_idx ON poop (user_id, log_time DESC, id DESC);
+
+-- Incremental sync (id > watermark) and the per-user log version
+CREATE INDEX CONCURRENTLY IF NOT EXISTS poop_user_id_id_idx ON poop (user_id, id);
+
+-- Public user directory
+CREATE INDEX CONCURRENTLY IF NOT EXISTS users_public_idx ON users (id) WHERE (config->>'public')::boolean = true;
@@ -0,0 +1,7 @@
+-- migrate: no-transaction
+-- Client-generated keys that make batch ingestion retries safe.
+
+ALTER TABLE poop ADD COLUMN IF NOT EXISTS idempotency_key TEXT;
+
+-- Rows without a key (NULL) never conflict with each other
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS poop_user_id_idempotency_key_idx ON poop (user_id, idempotency_key);
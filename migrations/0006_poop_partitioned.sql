@@ -0,0 +1,93 @@
+-- A copy of poop range-partitioned by month, filled online and swapped in
+-- by `python migrate.py partition-poop` (see migrate.py).
+--
+-- Partitioned tables need the partition key in every unique index, so the
+-- primary key becomes (id, log_time) and idempotency keys are unique per
+-- (user_id, idempotency_key, log_time); ids still come from poop_id_seq.
+-- Index names get their final poop_* names at the swap.
+
+CREATE TABLE poop_partitioned (
+    id INTEGER NOT NULL DEFAULT nextval('poop_id_seq'),
+    user_id INTEGER NOT NULL REFERENCES users (id),
+    log_time TIMESTAMP NOT NULL,
+    idempotency_key TEXT,
+    PRIMARY KEY (id, log_time)
+) PARTITION BY RANGE (log_time);
+
+CREATE INDEX poop_partitioned_user_id_log_time_idx ON poop_partitioned (user_id, log_time DESC, id DESC);
+CREATE INDEX poop_partitioned_user_id_id_idx ON poop_partitioned (user_id, id);
+CREATE UNIQUE INDEX poop_partitioned_user_id_idempotency_key_idx
+    ON poop_partitioned (user_id, idempotency_key, log_time);
+
+-- Monthly partitions poop_yYYYYmMM, up to `months_ahead` months past the
+-- current one. poop_history and poop_future catch entries before the first
+-- and after the last month; there is no DEFAULT partition, which would stop
+-- the planner from scanning partitions in log_time order for LIMIT queries.
+-- Each new month is split off poop_future, moving any entries already
+-- logged for it. Returns the number of partitions created.
+CREATE OR REPLACE FUNCTION create_poop_partitions(parent regclass, months_ahead integer, since timestamp DEFAULT NULL)
+RETURNS integer AS $$
+DECLARE
+    next_month timestamp;
+    last_month timestamp := date_trunc('month', now()::timestamp) + make_interval(months => months_ahead);
+    created integer := 0;
+BEGIN
+    SELECT max(to_date(substring(c.relname from '^poop_y(\d{4}m\d{2})$'), 'YYYY"m"MM'))::timestamp
+    INTO next_month
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = parent AND c.relname ~ '^poop_y\d{4}m\d{2}$';
+
+    IF next_month IS NULL THEN
+        next_month := date_trunc('month', COALESCE(since, now()::timestamp));
+        EXECUTE format('CREATE TABLE poop_history PARTITION OF %s FOR VALUES FROM (MINVALUE) TO (%L)',
+                       parent, next_month);
+        EXECUTE format('CREATE TABLE poop_future PARTITION OF %s FOR VALUES FROM (%L) TO (MAXVALUE)',
+                       parent, next_month);
+    ELSE
+        next_month := next_month + interval '1 month';
+    END IF;
+
+    WHILE next_month <= last_month LOOP
+        EXECUTE format('ALTER TABLE %s DETACH PARTITION poop_future', parent);
+        EXECUTE format('CREATE TABLE %I PARTITION OF %s FOR VALUES FROM (%L) TO (%L)',
+                       'poop_y' || to_char(next_month, 'YYYY"m"MM'), parent,
+                       next_month, next_month + interval '1 month');
+        EXECUTE format('WITH moved AS (DELETE FROM poop_future WHERE log_time < %L RETURNING *) '
+                       'INSERT INTO %s SELECT * FROM moved',
+                       next_month + interval '1 month', parent);
+        EXECUTE format('ALTER TABLE %s ATTACH PARTITION poop_future FOR VALUES FROM (%L) TO (MAXVALUE)',
+                       parent, next_month + interval '1 month');
+        next_month := next_month + interval '1 month';
+        created := created + 1;
+    END LOOP;
+    RETURN created;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Partitions from the oldest logged day (the rollup is much smaller than poop)
+SELECT create_poop_partitions('poop_partitioned', 3, (SELECT MIN(first_time) FROM poop_daily));
+
+-- Until the swap, every write to poop is repeated on the copy (entries are
+-- never updated), so the backfill only has to copy what existed before this.
+CREATE OR REPLACE FUNCTION poop_mirror_to_partitioned() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO poop_partitioned (id, user_id, log_time, idempotency_key)
+        VALUES (NEW.id, NEW.user_id, NEW.log_time, NEW.idempotency_key)
+        ON CONFLICT DO NOTHING;
+        RETURN NEW;
+    END IF;
+    DELETE FROM poop_partitioned WHERE id = OLD.id AND log_time = OLD.log_time;
+    RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER poop_mirror_to_partitioned
+    AFTER INSERT OR DELETE ON poop
+    FOR EACH ROW EXECUTE FUNCTION poop_mirror_to_partitioned();
+
+-- Creating the trigger waited for in-flight writes, so every entry up to
+-- this id predates it and is left for the backfill; `done` is its progress.
+CREATE TABLE poop_partition_backfill AS
+SELECT COALESCE(MAX(id), 0) AS high, 0 AS done FROM poop;
@@ -1,17 +1,30 @@
 from flask_login import UserMixin
-import psycopg2
-from config import db_config
+from datetime import datetime
+import base64
+import json
+
+from cache import TTLCache, get_shared_backend
+from config import (
+    CROSS_WORKER_CACHES,
+    LIVE_UPDATES_ENABLED,
+    SYNC_LOOKBACK_IDS,
+    PUBLIC_USERS_CACHE_TTL,
+    USER_CACHE_SIZE,
+    USER_CACHE_TTL,
+)
+from db import get_pool, get_db, mark_recent_write
 
 
 def get_db_connection():
-    """Create a database connection."""
-    return psycopg2.connect(
-        host=db_config['host'],
-        user=db_config['user'],
-        password=db_config['password'],
-        dbname=db_config['database'],
-        sslmode=db_config['sslmode']
-    )
+    """Check a connection out of the pool; use as `with get_db_connection() as conn:`."""
+    return get_pool().connection()
+
+
+def parse_config(raw):
+    """Return a user's config column as a dict (it may come back as JSON text)."""
+    if not raw:
+        return {}
+    return json.loads(raw) if isinstance(raw, str) else raw
 
 
 class User(UserMixin):
@@ -19,41 +32,463 @@ class User(UserMixin):
         self.id = id
         self.email = email
         self.username = username
-        self.config = config
+        self.config = parse_config(config)
+
+    @property
+    def is_public(self):
+        return bool(self.config.get('public'))
+
+
+# Session users, as user_id -> (version, (id, username, email, config)).
+# The version is a per-user counter in the shared backend, so a change made
+# through one worker invalidates the copies held by every other. That needs
+# CACHE_URL when several workers run, so otherwise (see CROSS_WORKER_CACHES)
+# every request loads the user from the database.
+USER_VERSION_KEY = 'user:version:{}'
+_user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
 
 
 def load_user_by_id(user_id):
-    """Load a user from the database by ID."""
+    """Load a user by ID, from the cache when possible."""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT id, username, email, password_hash, config, created_at FROM users WHERE id = %s",
-            (user_id,)
-        )
-        user_data = cursor.fetchone()
-        conn.close()
+        user_id = int(user_id)
+        version = get_shared_backend().get_counter(USER_VERSION_KEY.format(user_id))
+        cached = _user_cache.get(user_id) if CROSS_WORKER_CACHES else None
+        if cached is not None and cached[0] == version:
+            user_data = cached[1]
+        else:
+            cursor = get_db().cursor()
+            cursor.execute("SELECT id, username, email, config FROM users WHERE id = %s", (user_id,))
+            user_data = cursor.fetchone()
+            if user_data and CROSS_WORKER_CACHES:
+                _user_cache.set(user_id, (version, user_data))
 
         if user_data:
-            return User(user_data[0], user_data[2], user_data[1], user_data[4])
+            return User(user_data[0], user_data[2], user_data[1], user_data[3])
     except Exception as e:
         print(f"Error loading user: {e}")
 
     return None
 
 
+def invalidate_user(user_id):
+    """Drop every worker's cached copy of a user; call after changing their row."""
+    _user_cache.delete(user_id)
+    get_shared_backend().incr(USER_VERSION_KEY.format(user_id))
+
+
 def get_user_by_email(email):
     """Load a user from the database by email."""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        cursor = get_db().cursor()
         cursor.execute(
             "SELECT id, username, email, password_hash, config, created_at FROM users WHERE email = %s",
             (email,)
         )
-        user_data = cursor.fetchone()
-        conn.close()
-        return user_data
+        return cursor.fetchone()
     except Exception as e:
         print(f"Error loading user by email: {e}")
         return None
+
+
+# The public user directory only changes on registration or a privacy change.
+# Each worker keeps a copy tagged with a version counter held in the shared
+# backend; bumping the counter invalidates every worker's copy at once.
+PUBLIC_USERS_VERSION_KEY = 'public_users:version'
+_public_users_cache = TTLCache(4, PUBLIC_USERS_CACHE_TTL)
+
+
+def peek_public_users():
+    """
+    Return (version, users) from the cache; users is None on a miss.
+
+    For callers that fold the directory query into one of their own; they
+    hand the result back with remember_public_users(version, users).
+    """
+    version = get_shared_backend().get_counter(PUBLIC_USERS_VERSION_KEY)
+    return version, _public_users_cache.get(version)
+
+
+def remember_public_users(version, users):
+    users = tuple(tuple(user) for user in users)
+    _public_users_cache.set(version, users)
+    return users
+
+
+def get_public_users():
+    """Return (id, username) for every public user, ordered by id."""
+    version, users = peek_public_users()
+    if users is None:
+        cursor = get_db().cursor()
+        cursor.execute(
+            "SELECT id, username FROM users WHERE (config->>'public')::boolean = true ORDER BY id ASC"
+        )
+        users = remember_public_users(version, cursor.fetchall())
+    return users
+
+
+def invalidate_public_users():
+    """Drop every worker's cached public directory; call after it may have changed."""
+    get_shared_backend().incr(PUBLIC_USERS_VERSION_KEY)
+
+
+# Per-user data version, bumped whenever a user's logs change; caches of
+# anything derived from those logs include it in their keys.
+USER_DATA_VERSION_KEY = 'user_data:version:{}'
+
+
+def get_user_data_version(user_id):
+    return get_shared_backend().get_counter(USER_DATA_VERSION_KEY.format(user_id))
+
+
+def invalidate_user_data(user_id):
+    """
+    Mark a user's cached pages stale and keep reads of their data on the
+    primary for a while; call after committing a change to their logs.
+    """
+    mark_recent_write(user_id)
+    get_shared_backend().incr(USER_DATA_VERSION_KEY.format(user_id))
+
+
+def encode_log_cursor(log_time, log_id):
+    """Opaque keyset cursor pointing just past the given (log_time, id)."""
+    raw = json.dumps([log_time.isoformat(), log_id]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+
+def decode_log_cursor(token):
+    """Inverse of encode_log_cursor; raises ValueError on a malformed cursor."""
+    try:
+        log_time, log_id = json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+        return datetime.fromisoformat(log_time), int(log_id)
+    except Exception:
+        raise ValueError('Invalid cursor')
+
+
+def _log_range_conditions(user_id, since, until):
+    conditions = ["user_id = %s"]
+    params = [user_id]
+    if since:
+        conditions.append("log_time >= %s")
+        params.append(since)
+    if until:
+        conditions.append("log_time < %s")
+        params.append(until)
+    return conditions, params
+
+
+def fetch_logs_page(cursor, user_id, limit, after=None, since=None, until=None):
+    """
+    Fetch one page of a user's logs, newest first, using keyset pagination.
+
+    `after` is a cursor from a previous page; `since`/`until` bound log_time
+    (inclusive/exclusive). Returns (rows, next_cursor), where next_cursor is
+    None on the last page. A `limit` of None returns every matching row.
+    """
+    conditions, params = _log_range_conditions(user_id, since, until)
+    if after:
+        after_time, after_id = decode_log_cursor(after)
+        # The plain bound lets the planner skip newer partitions, which it
+        # can't do from the row comparison alone
+        conditions.append("log_time <= %s AND (log_time, id) < (%s, %s)")
+        params.extend((after_time, after_time, after_id))
+
+    sql = f"""
+        SELECT id, user_id, log_time FROM poop
+        WHERE {' AND '.join(conditions)}
+        ORDER BY log_time DESC, id DESC
+        LIMIT %s
+    """
+    cursor.execute(sql, (*params, None if limit is None else limit + 1))
+    rows = cursor.fetchall()
+
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_log_cursor(rows[-1][2], rows[-1][0])
+    return rows, next_cursor
+
+
+def iter_logs(conn, user_id, since=None, until=None, itersize=2000):
+    """
+    Yield a user's (id, log_time) rows oldest first from a server-side cursor,
+    fetching `itersize` rows per round trip, so memory use doesn't grow with
+    the history. Must run inside a transaction on `conn`.
+    """
+    conditions, params = _log_range_conditions(user_id, since, until)
+    cursor = conn.cursor(name=f'log_export_{user_id}')
+    cursor.itersize = itersize
+    try:
+        cursor.execute(
+            f"SELECT id, log_time FROM poop WHERE {' AND '.join(conditions)} ORDER BY log_time, id",
+            params
+        )
+        yield from cursor
+    finally:
+        cursor.close()
+
+
+def count_logs(cursor, user_id, since=None, until=None):
+    """Count a user's logs, optionally within a log_time range."""
+    if not since and not until:
+        cursor.execute("SELECT COALESCE(SUM(count), 0) FROM poop_daily WHERE user_id = %s", (user_id,))
+        return cursor.fetchone()[0]
+    # Whole days in [since, until) are summed from the rollup; only the
+    # partial days at either end are counted from poop. A missing bound is
+    # infinite, which leaves that end's poop range empty.
+    since_ts = "COALESCE(%(since)s::timestamp, '-infinity')"
+    until_ts = "COALESCE(%(until)s::timestamp, 'infinity')"
+    first_day = f"date_trunc('day', {since_ts} + interval '1 day' - interval '1 microsecond')"
+    end_day = f"date_trunc('day', {until_ts})"
+    cursor.execute(
+        f"""
+        SELECT (SELECT COALESCE(SUM(count), 0) FROM poop_daily
+                WHERE user_id = %(user_id)s AND day >= {first_day} AND day < {end_day})
+             + (SELECT COUNT(*) FROM poop
+                WHERE user_id = %(user_id)s AND log_time >= {since_ts}
+                  AND log_time < LEAST({first_day}, {until_ts}))
+             + (SELECT COUNT(*) FROM poop
+                WHERE user_id = %(user_id)s AND log_time >= GREATEST({first_day}, {end_day})
+                  AND log_time < {until_ts})
+        """,
+        {'user_id': user_id, 'since': since, 'until': until}
+    )
+    return cursor.fetchone()[0]
+
+
+def get_last_log_time(cursor, user_id):
+    """Return the time of a user's most recent log, or None."""
+    cursor.execute("SELECT last_time FROM poop_daily WHERE user_id = %s ORDER BY day DESC LIMIT 1", (user_id,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def insert_log(cursor, user_id, log_time):
+    """Insert a log entry, update the daily rollup and return its id. The caller commits."""
+    cursor.execute(
+        """
+        WITH new AS (
+            INSERT INTO poop (user_id, log_time) VALUES (%s, %s) RETURNING id, user_id, log_time
+        ), rollup AS (
+            INSERT INTO poop_daily (user_id, day, count, first_time, last_time)
+            SELECT user_id, log_time::date, 1, log_time, log_time FROM new
+            ON CONFLICT (user_id, day) DO UPDATE
+            SET count = poop_daily.count + 1,
+                first_time = LEAST(poop_daily.first_time, EXCLUDED.first_time),
+                last_time = GREATEST(poop_daily.last_time, EXCLUDED.last_time)
+        )
+        SELECT id FROM new
+        """,
+        (user_id, log_time)
+    )
+    return cursor.fetchone()[0]
+
+
+def insert_logs(cursor, entries):
+    """
+    Insert (user_id, log_time) entries, possibly for many users, in one
+    statement and update the daily rollup. Returns the new (id, user_id,
+    log_time) rows. The caller commits.
+    """
+    cursor.execute(
+        """
+        WITH new AS (
+            INSERT INTO poop (user_id, log_time)
+            SELECT * FROM unnest(%s::int[], %s::timestamp[])
+            RETURNING id, user_id, log_time
+        ), rollup AS (
+            INSERT INTO poop_daily (user_id, day, count, first_time, last_time)
+            SELECT user_id, log_time::date, COUNT(*), MIN(log_time), MAX(log_time) FROM new
+            GROUP BY 1, 2
+            ON CONFLICT (user_id, day) DO UPDATE
+            SET count = poop_daily.count + EXCLUDED.count,
+                first_time = LEAST(poop_daily.first_time, EXCLUDED.first_time),
+                last_time = GREATEST(poop_daily.last_time, EXCLUDED.last_time)
+        )
+        SELECT id, user_id, log_time FROM new
+        """,
+        ([user_id for user_id, _ in entries], [log_time for _, log_time in entries])
+    )
+    return cursor.fetchall()
+
+
+def insert_logs_batch(cursor, user_id, entries):
+    """
+    Insert many (idempotency_key, log_time) entries in one statement and update
+    the daily rollup. Keys that already exist for the user are skipped.
+
+    Returns {idempotency_key: (id, created)}; a key whose row was committed by a
+    concurrent request while this one ran maps to (None, False). The caller commits.
+    """
+    keys = [key for key, _ in entries]
+    cursor.execute(
+        """
+        WITH input (idempotency_key, log_time) AS (
+            SELECT * FROM unnest(%(keys)s::text[], %(times)s::timestamp[])
+        ), new AS (
+            INSERT INTO poop (user_id, log_time, idempotency_key)
+            SELECT %(user_id)s, log_time, idempotency_key FROM input
+            WHERE NOT EXISTS (
+                SELECT 1 FROM poop p
+                WHERE p.user_id = %(user_id)s AND p.idempotency_key = input.idempotency_key
+            )
+            -- The unique index includes log_time (the partition key), so it
+            -- only catches a concurrent retry; the check above catches the rest
+            ON CONFLICT DO NOTHING
+            RETURNING id, user_id, log_time, idempotency_key
+        ), rollup AS (
+            INSERT INTO poop_daily (user_id, day, count, first_time, last_time)
+            SELECT user_id, log_time::date, COUNT(*), MIN(log_time), MAX(log_time) FROM new
+            GROUP BY 1, 2
+            ON CONFLICT (user_id, day) DO UPDATE
+            SET count = poop_daily.count + EXCLUDED.count,
+                first_time = LEAST(poop_daily.first_time, EXCLUDED.first_time),
+                last_time = GREATEST(poop_daily.last_time, EXCLUDED.last_time)
+        )
+        SELECT idempotency_key, id, true FROM new
+        UNION ALL
+        -- The statement's snapshot predates its own inserts, so these are the earlier copies
+        SELECT idempotency_key, id, false FROM poop
+        WHERE user_id = %(user_id)s AND idempotency_key = ANY(%(keys)s)
+        """,
+        {'user_id': user_id, 'keys': keys, 'times': [log_time for _, log_time in entries]}
+    )
+    results = {key: (None, False) for key in keys}
+    for key, log_id, created in cursor.fetchall():
+        results[key] = (log_id, created)
+    return results
+
+
+def refresh_daily_rollup(cursor, user_id, day):
+    """Recompute one user's rollup row for one day from the raw logs."""
+    # Lock the row first, in its own statement: a concurrent insert holding it
+    # has then committed, and the aggregate below (a fresh snapshot) counts
+    # its entry instead of overwriting its +1 with a stale count
+    cursor.execute(
+        "SELECT 1 FROM poop_daily WHERE user_id = %s AND day = %s FOR UPDATE",
+        (user_id, day)
+    )
+    cursor.execute(
+        """
+        WITH s AS (
+            SELECT COUNT(*) AS count, MIN(log_time) AS first_time, MAX(log_time) AS last_time
+            FROM poop
+            WHERE user_id = %(user_id)s AND log_time >= %(day)s AND log_time < %(day)s + 1
+        ), updated AS (
+            UPDATE poop_daily d
+            SET count = s.count, first_time = s.first_time, last_time = s.last_time
+            FROM s
+            WHERE d.user_id = %(user_id)s AND d.day = %(day)s AND s.count > 0
+        )
+        DELETE FROM poop_daily d
+        USING s
+        WHERE d.user_id = %(user_id)s AND d.day = %(day)s AND s.count = 0
+        """,
+        {'user_id': user_id, 'day': day}
+    )
+
+
+def delete_log(cursor, user_id, entry_id):
+    """
+    Delete one of a user's log entries, leaving a tombstone for sync clients
+    and updating the daily rollup.
+    Returns the number of entries deleted (0 or 1). The caller commits.
+    """
+    cursor.execute(
+        """
+        WITH deleted AS (
+            DELETE FROM poop WHERE id = %s AND user_id = %s RETURNING id, user_id, log_time
+        ), tombstone AS (
+            INSERT INTO poop_tombstones (poop_id, user_id)
+            SELECT id, user_id FROM deleted
+        )
+        SELECT log_time::date FROM deleted
+        """,
+        (entry_id, user_id)
+    )
+    days = [row[0] for row in cursor.fetchall()]
+    for day in days:
+        refresh_daily_rollup(cursor, user_id, day)
+    return len(days)
+
+
+def get_log_version(cursor, user_id):
+    """
+    Return a user's (latest log id, latest tombstone id, log count).
+
+    Ids only grow, and an entry committed late with a lower id still changes
+    the count, so the tuple changes whenever the user's logs do.
+    """
+    cursor.execute(
+        """
+        SELECT (SELECT COALESCE(MAX(id), 0) FROM poop WHERE user_id = %s),
+               (SELECT COALESCE(MAX(id), 0) FROM poop_tombstones WHERE user_id = %s),
+               (SELECT COALESCE(SUM(count), 0) FROM poop_daily WHERE user_id = %s)
+        """,
+        (user_id, user_id, user_id)
+    )
+    return cursor.fetchone()
+
+
+def fetch_log_changes(cursor, user_id, since_log_id, since_tombstone_id):
+    """
+    Return the (inserted rows, (tombstone id, poop id) pairs) recorded after
+    the given watermark.
+
+    Ids are assigned when a row is inserted but become visible when it
+    commits, so a row can appear behind a watermark already handed out.
+    Both lists therefore start SYNC_LOOKBACK_IDS before the watermark and
+    may repeat changes the client has already applied.
+    """
+    cursor.execute(
+        "SELECT id, user_id, log_time FROM poop WHERE user_id = %s AND id > %s ORDER BY id",
+        (user_id, max(since_log_id - SYNC_LOOKBACK_IDS, 0))
+    )
+    inserted = cursor.fetchall()
+    cursor.execute(
+        "SELECT id, poop_id FROM poop_tombstones WHERE user_id = %s AND id > %s ORDER BY id",
+        (user_id, max(since_tombstone_id - SYNC_LOOKBACK_IDS, 0))
+    )
+    deleted = cursor.fetchall()
+    return inserted, deleted
+
+
+# Postgres NOTIFY channel carrying log changes to live dashboards (see live.py)
+LOG_CHANGES_CHANNEL = 'poop_changes'
+# NOTIFY payloads must stay under 8000 bytes
+MAX_NOTIFY_PAYLOAD = 7900
+
+
+def _log_change_payload(user_id, inserted, deleted):
+    payload = json.dumps({
+        'user_id': user_id,
+        'inserted': [{'id': log_id, 'log_time': log_time.strftime('%Y-%m-%dT%H:%M:%S')}
+                     for log_id, log_time in inserted],
+        'deleted': list(deleted),
+    })
+    if len(payload) > MAX_NOTIFY_PAYLOAD:
+        # Too large for one notification; subscribers refetch instead
+        payload = json.dumps({'user_id': user_id, 'resync': True})
+    return payload
+
+
+def notify_log_changes(cursor, user_id, inserted=(), deleted=()):
+    """
+    Announce a user's new (id, log_time) entries and deleted ids to live
+    subscribers. Postgres delivers it when the caller commits, and drops it
+    on rollback.
+    """
+    if not LIVE_UPDATES_ENABLED or not (inserted or deleted):
+        return
+    cursor.execute("SELECT pg_notify(%s, %s)", (LOG_CHANGES_CHANNEL, _log_change_payload(user_id, inserted, deleted)))
+
+
+def notify_logs_inserted(cursor, rows):
+    """notify_log_changes() for (id, user_id, log_time) rows of many users, in one statement."""
+    if not LIVE_UPDATES_ENABLED or not rows:
+        return
+    by_user = {}
+    for log_id, user_id, log_time in rows:
+        by_user.setdefault(user_id, []).append((log_id, log_time))
+    payloads = [_log_change_payload(user_id, inserted, ()) for user_id, inserted in by_user.items()]
+    cursor.execute("SELECT pg_notify(%s, payload) FROM unnest(%s::text[]) AS payload", (LOG_CHANGES_CHANNEL, payloads))
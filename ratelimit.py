@@ -0,0 +1,145 @@
+"""
+Per-client rate limiting for the expensive routes.
+
+Limits are sliding-window counters kept in the shared cache backend (Redis
+when CACHE_URL is set, per-process memory otherwise), keyed by client IP
+and, for credential checks, by the email being tried. They are enforced in a
+before_request hook, so an over-limit request is rejected with 429 and a
+Retry-After header before any password hashing or database work happens.
+The limits themselves are RATE_LIMITS in config.py.
+"""
+
+import hashlib
+import math
+import threading
+import time
+
+from flask import request, current_app
+
+from cache import get_shared_backend
+from config import RATE_LIMITS, RATE_LIMITS_ENABLED
+
+# Viewing the login/register forms carries no credentials. API routes are
+# never exempt: several accept email + password on GET.
+_SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class RateLimiter:
+    """
+    Sliding-window rate limiter.
+
+    Each (rule, identity) keeps one counter per fixed window; the current
+    count is this window's hits plus the previous window's, weighted by how
+    much of it still overlaps the sliding window.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._lock = threading.Lock()
+        self.rejected = {}  # rule name -> requests rejected
+
+    def hit(self, name, identity, limit, window):
+        """Record a hit. Returns None if allowed, or the seconds to wait before retrying."""
+        now = time.time()
+        current = int(now // window)
+        elapsed = now - current * window
+        key = f"ratelimit:{name}:{identity}:{window}:"
+
+        count = self.backend.incr(key + str(current), ttl=window * 2)
+        previous = self.backend.get_counter(key + str(current - 1))
+        remaining = window - elapsed
+        if previous * remaining / window + count <= limit:
+            return None
+
+        with self._lock:
+            self.rejected[name] = self.rejected.get(name, 0) + 1
+        if count > limit or not previous:
+            # Over the limit on this window's hits alone
+            return max(1, math.ceil(remaining))
+        # Wait until enough of the previous window has slid out
+        return max(1, math.ceil(remaining - (limit - count) * window / previous))
+
+
+_limiter = None
+
+
+def get_limiter():
+    global _limiter
+    if _limiter is None:
+        _limiter = RateLimiter(get_shared_backend())
+    return _limiter
+
+
+def _client_ip():
+    return request.remote_addr or 'unknown'
+
+
+def _submitted_email():
+    """The email a credential check is being tried against, if any."""
+    email = request.form.get('email')
+    if email is None:
+        data = request.get_json(silent=True)
+        if isinstance(data, dict) and isinstance(data.get('email'), str):
+            email = data['email']
+    if not email:
+        return None
+    # Hashed, so addresses don't end up as keys in the shared backend
+    return hashlib.sha256(email.strip().lower().encode('utf-8')).hexdigest()[:32]
+
+
+def _uses_credentials():
+    """True for API requests authenticating with email + password instead of a token."""
+    if request.headers.get('Authorization', '').startswith('Bearer '):
+        return False
+    data = request.get_json(silent=True)
+    return isinstance(data, dict) and 'password' in data
+
+
+def _rules_for_request():
+    if request.blueprint == 'auth' and request.method in _SAFE_METHODS:
+        return []
+    rules = []
+    if request.endpoint in RATE_LIMITS:
+        rules.append((request.endpoint, RATE_LIMITS[request.endpoint]))
+    if request.blueprint in ('api', 'poop') and request.endpoint not in RATE_LIMITS and _uses_credentials():
+        # Legacy clients re-sending credentials on every call (see api_auth)
+        rules.append(('api.credentials', RATE_LIMITS['api.credentials']))
+    return rules
+
+
+def _too_many_requests(retry_after):
+    headers = {'Retry-After': str(retry_after)}
+    if request.path.startswith('/api/'):
+        return {'error': 'Too many requests, try again later', 'retry_after': retry_after}, 429, headers
+    return f"Massa intents. Torna-ho a provar d'aquí a {retry_after} segons.", 429, headers
+
+
+def check_rate_limits():
+    """
+    before_request hook: reject the request if any of its limits is exceeded.
+    """
+    limiter = get_limiter()
+    retry_after = 0
+    for name, limits in _rules_for_request():
+        for scope, (limit, window) in limits.items():
+            identity = _client_ip() if scope == 'ip' else _submitted_email()
+            if identity is None:
+                continue
+            try:
+                wait = limiter.hit(f"{name}:{scope}", identity, limit, window)
+            except Exception as e:
+                # Never take the site down because the limiter's backend is down
+                current_app.logger.warning(f"Rate limiter unavailable: {e}")
+                return None
+            if wait:
+                retry_after = max(retry_after, wait)
+
+    if retry_after:
+        current_app.logger.info(f"Rate limited {request.endpoint} from {_client_ip()}")
+        return _too_many_requests(retry_after)
+    return None
+
+
+def init_app(app):
+    if RATE_LIMITS_ENABLED:
+        app.before_request(check_rate_limits)
@@ -0,0 +1,91 @@
+"""
+Maintenance for the poop_daily rollup table.
+
+    flask --app app rollup rebuild [--user-id N]
+    flask --app app rollup check [--fix]
+"""
+
+import click
+from flask.cli import AppGroup
+
+from models import get_db_connection
+
+rollup_cli = AppGroup('rollup', help='Maintain the poop_daily rollup.')
+
+
+def rebuild_rollup(conn, user_id=None):
+    """Recompute the rollup from the raw logs, for one user or everyone."""
+    where = "WHERE user_id = %s" if user_id is not None else ""
+    params = (user_id,) if user_id is not None else ()
+
+    cursor = conn.cursor()
+    # Writers upsert the rollup in the same statement as their poop insert,
+    # so holding this lock means no write is half-counted by the rebuild.
+    cursor.execute("LOCK TABLE poop_daily IN EXCLUSIVE MODE")
+    cursor.execute(f"DELETE FROM poop_daily {where}", params)
+    cursor.execute(
+        f"""
+        INSERT INTO poop_daily (user_id, day, count, first_time, last_time)
+        SELECT user_id, log_time::date, COUNT(*), MIN(log_time), MAX(log_time)
+        FROM poop
+        {where}
+        GROUP BY 1, 2
+        """,
+        params
+    )
+    rows = cursor.rowcount
+    conn.commit()
+    return rows
+
+
+def find_rollup_mismatches(conn):
+    """Return (user_id, day, rollup row, actual row) for every day that disagrees."""
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        SELECT COALESCE(r.user_id, p.user_id), COALESCE(r.day, p.day),
+               r.count, r.first_time, r.last_time,
+               p.count, p.first_time, p.last_time
+        FROM poop_daily r
+        FULL OUTER JOIN (
+            SELECT user_id, log_time::date AS day, COUNT(*) AS count,
+                   MIN(log_time) AS first_time, MAX(log_time) AS last_time
+            FROM poop
+            GROUP BY 1, 2
+        ) p ON p.user_id = r.user_id AND p.day = r.day
+        WHERE r.count IS DISTINCT FROM p.count
+           OR r.first_time IS DISTINCT FROM p.first_time
+           OR r.last_time IS DISTINCT FROM p.last_time
+        ORDER BY 1, 2
+        """
+    )
+    return [(row[0], row[1], row[2:5], row[5:8]) for row in cursor.fetchall()]
+
+
+@rollup_cli.command('rebuild')
+@click.option('--user-id', type=int, default=None, help='Only rebuild this user.')
+def rebuild_command(user_id):
+    """Backfill or rebuild poop_daily from the poop table."""
+    with get_db_connection() as conn:
+        rows = rebuild_rollup(conn, user_id)
+    click.echo(f"Rebuilt {rows} rollup rows.")
+
+
+@rollup_cli.command('check')
+@click.option('--fix', is_flag=True, help='Rebuild the users whose rollup is wrong.')
+def check_command(fix):
+    """Compare poop_daily with the raw logs; exits non-zero on mismatches."""
+    with get_db_connection() as conn:
+        mismatches = find_rollup_mismatches(conn)
+        for user_id, day, rollup, actual in mismatches:
+            click.echo(f"user {user_id} {day}: rollup {rollup} != actual {actual}")
+
+        if mismatches and fix:
+            for user_id in sorted({m[0] for m in mismatches}):
+                rebuild_rollup(conn, user_id)
+            click.echo(f"Rebuilt rollup for {len({m[0] for m in mismatches})} users.")
+            return
+
+    if mismatches:
+        raise SystemExit(1)
+    click.echo("Rollup is consistent.")
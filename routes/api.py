@@ -1,59 +1,72 @@
 """
 API endpoints for the mobile app.
-All endpoints use JSON auth (email + password in request body).
+Endpoints authenticate with a Bearer access token issued by /api/login, or
+with email + password in the JSON body for older clients.
 """
 
-from flask import Blueprint, request, current_app
-from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime, timedelta
+from flask import Blueprint, Response, request, current_app, g, stream_with_context
+from werkzeug.http import quote_etag
+from datetime import datetime
+import csv
+import hashlib
+import io
 import json
 
-from models import get_db_connection
+from api_auth import (
+    api_auth_required,
+    authenticate_credentials,
+    invalidate_user_credentials,
+    issue_tokens,
+    revoke_access_token,
+    token_version,
+    verify_refresh_token,
+)
+from db import get_db, get_read_db
+from hashing import HashPoolBusy, RETRY_AFTER, hash_password
+from config import API_LOGS_DEFAULT_PAGE_SIZE, API_LOGS_MAX_PAGE_SIZE, EXPORT_ITERSIZE, LIVE_UPDATES_ENABLED
+from live import can_watch, event_stream
+from models import (
+    parse_config,
+    fetch_logs_page,
+    iter_logs,
+    count_logs,
+    decode_log_cursor,
+    get_last_log_time,
+    delete_log,
+    get_log_version,
+    fetch_log_changes,
+    get_public_users,
+    invalidate_public_users,
+    invalidate_user,
+    invalidate_user_data,
+    notify_log_changes,
+)
+from stats import SERIES_VIEWS, get_series, get_summary, humanize_last_entry
 
 api_bp = Blueprint('api', __name__, url_prefix='/api')
 
 
-def _authenticate(data):
-    """Authenticate a user from JSON data. Returns (user_tuple, error_response)."""
-    if not data or 'email' not in data or 'password' not in data:
-        return None, ({'error': 'email and password are required'}, 400)
+def _etag(*parts):
+    """Build an ETag value from anything the response body depends on."""
+    return hashlib.sha1(json.dumps(parts, default=str, sort_keys=True).encode('utf-8')).hexdigest()
 
-    email = data['email']
-    password = data['password']
 
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT id, username, email, password_hash, config FROM users WHERE email = %s",
-            (email,)
-        )
-        user_data = cursor.fetchone()
-        conn.close()
-
-        if not user_data or not check_password_hash(user_data[3], password):
-            return None, ({'error': 'Invalid email or password'}, 401)
-
-        return user_data, None
-
-    except Exception as e:
-        current_app.logger.error(f"Auth error: {e}")
-        return None, ({'error': 'Authentication failed'}, 500)
+def _not_modified(etag):
+    """True when the client already holds the response identified by `etag`."""
+    return request.if_none_match.contains(etag)
 
 
 # ── Login ──────────────────────────────────────────────────────────────────────
 
 @api_bp.route('/login', methods=['POST'])
 def api_login():
-    """Validate credentials and return user info."""
+    """Validate credentials and return user info plus an access/refresh token pair."""
     data = request.get_json()
-    user_data, err = _authenticate(data)
+    user_data, err = authenticate_credentials(data)
     if err:
         return err
 
-    config = {}
-    if user_data[4]:
-        config = json.loads(user_data[4]) if isinstance(user_data[4], str) else user_data[4]
+    config = parse_config(user_data[4])
 
     return {
         'status': 'success',
@@ -62,10 +75,67 @@ def api_login():
             'username': user_data[1],
             'email': user_data[2],
             'config': config,
-        }
+        },
+        **issue_tokens(user_data),
     }, 200
 
 
+@api_bp.route('/token/refresh', methods=['POST'])
+def api_token_refresh():
+    """Exchange a refresh token for a new access/refresh token pair."""
+    data = request.get_json(silent=True) or {}
+    claims = verify_refresh_token(data.get('refresh_token', ''))
+    if claims is None:
+        return {'error': 'Invalid or expired refresh token'}, 401
+
+    try:
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, username, email, NULL, config FROM users WHERE id = %s", (claims['uid'],))
+        user_data = cursor.fetchone()
+
+        if not user_data or token_version(user_data[4]) != claims['tv']:
+            return {'error': 'Refresh token has been revoked'}, 401
+
+        return {'status': 'success', **issue_tokens(user_data)}, 200
+
+    except Exception as e:
+        current_app.logger.error(f"Token refresh error: {e}")
+        return {'error': str(e)}, 500
+
+
+@api_bp.route('/logout', methods=['POST'])
+@api_auth_required
+def api_logout():
+    """Revoke the caller's tokens: every refresh token, and the current access token."""
+    user_data = g.api_user
+
+    try:
+        conn = get_db()
+        cursor = conn.cursor()
+        sql = """
+            UPDATE users
+            SET config = jsonb_set(
+                COALESCE(config::jsonb, '{}'::jsonb), '{token_version}',
+                to_jsonb(COALESCE((config::jsonb->>'token_version')::int, 0) + 1)
+            )
+            WHERE id = %s
+        """
+        cursor.execute(sql, (user_data[0],))
+        conn.commit()
+        invalidate_user_credentials(user_data[0])
+        invalidate_user(user_data[0])
+
+        if g.api_token:
+            revoke_access_token(g.api_token)
+
+        return {'status': 'success', 'message': 'Logged out'}, 200
+
+    except Exception as e:
+        current_app.logger.error(f"Logout error: {e}")
+        return {'error': str(e)}, 500
+
+
 # ── Register ───────────────────────────────────────────────────────────────────
 
 @api_bp.route('/register', methods=['POST'])
@@ -91,15 +161,14 @@ def api_register():
         return {'error': 'Password must be at least 6 characters'}, 400
 
     try:
-        conn = get_db_connection()
+        conn = get_db()
         cursor = conn.cursor()
 
         cursor.execute("SELECT id FROM users WHERE email = %s", (email,))
         if cursor.fetchone():
-            conn.close()
             return {'error': 'Email already exists'}, 409
 
-        password_hash = generate_password_hash(password)
+        password_hash = hash_password(password)
         config_json = json.dumps({"public": privacy == "public"})
         created_at = datetime.now()
 
@@ -108,10 +177,14 @@ def api_register():
             (username, email, password_hash, config_json, created_at)
         )
         conn.commit()
-        conn.close()
+        if privacy == 'public':
+            invalidate_public_users()
 
         return {'status': 'success', 'message': 'Account created successfully'}, 201
 
+    except HashPoolBusy as e:
+        current_app.logger.warning(f"Register rejected: {e}")
+        return {'error': 'Server busy, try again shortly'}, 503, {'Retry-After': str(RETRY_AFTER)}
     except Exception as e:
         current_app.logger.error(f"Register error: {e}")
         return {'error': str(e)}, 500
@@ -119,90 +192,299 @@ def api_register():
 
 # ── Home / Dashboard Data ─────────────────────────────────────────────────────
 
-@api_bp.route('/home', methods=['POST'])
+@api_bp.route('/home', methods=['GET', 'POST'])
+@api_auth_required
 def api_home():
     """
     Return dashboard data (logs, users list, stats).
-    Optionally pass 'view_user_id' to see another public user's data.
+    Optionally pass 'view_user_id' to see another public user's data,
+    'series' (a list of chart views, see stats.SERIES_VIEWS) to get
+    pre-bucketed chart data, and 'logs': false to skip the raw log list.
+
+    Logs are paginated when 'limit' or 'cursor' is given: pass the returned
+    'next_cursor' back to get the next (older) page. 'since'/'until'
+    (ISO datetimes) restrict the log_time range. Without any of these the
+    full list is returned, as older app builds expect.
+
+    Responses carry an ETag; send it back in If-None-Match to get an empty
+    304 while nothing on the dashboard has changed.
     """
-    data = request.get_json()
-    user_data, err = _authenticate(data)
-    if err:
-        return err
+    data = request.get_json(silent=True) or {}
+    user_data = g.api_user
 
     my_id = user_data[0]
     view_user_id = data.get('view_user_id', my_id)
+    include_logs = data.get('logs', True)
+    series_views = data.get('series') or []
+
+    invalid_views = [v for v in series_views if v not in SERIES_VIEWS]
+    if invalid_views:
+        return {'error': f"series must be chosen from: {', '.join(SERIES_VIEWS)}"}, 400
 
+    paginate = 'limit' in data or 'cursor' in data
+    page_cursor = data.get('cursor')
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        limit = min(int(data.get('limit', API_LOGS_DEFAULT_PAGE_SIZE)), API_LOGS_MAX_PAGE_SIZE)
+        since = datetime.fromisoformat(data['since']) if data.get('since') else None
+        until = datetime.fromisoformat(data['until']) if data.get('until') else None
+        if page_cursor:
+            decode_log_cursor(page_cursor)
+    except (TypeError, ValueError) as e:
+        return {'error': f'Invalid pagination parameters: {e}'}, 400
+    if limit < 1:
+        return {'error': 'limit must be positive'}, 400
 
-        # Fetch public users
-        cursor.execute(
-            "SELECT id, username, email FROM users WHERE (config->>'public')::boolean = true ORDER BY id ASC"
-        )
-        public_users = [{'id': r[0], 'username': r[1]} for r in cursor.fetchall()]
+    try:
+        cursor = get_read_db(view_user_id).cursor()
+
+        # Fetch public users (cached)
+        public_users = [{'id': r[0], 'username': r[1]} for r in get_public_users()]
 
         # If the authenticated user is private, ensure they appear in the list
-        cursor.execute("SELECT config->>'public' FROM users WHERE id = %s", (my_id,))
-        priv = cursor.fetchone()
-        my_is_public = priv and priv[0] == 'true'
+        my_is_public = parse_config(user_data[4]).get('public')
         if not my_is_public:
             already = any(u['id'] == my_id for u in public_users)
             if not already:
                 public_users.append({'id': my_id, 'username': user_data[1]})
 
-        # Fetch logs for the viewed user
-        cursor.execute(
-            "SELECT id, user_id, log_time FROM poop WHERE user_id = %s ORDER BY log_time DESC",
-            (view_user_id,)
+        # Everything below depends only on these, plus the clock for the
+        # rolling stats and the humanized last entry (hence the hour)
+        params = {k: v for k, v in data.items() if k not in ('email', 'password')}
+        etag = _etag(
+            view_user_id, params, public_users, get_log_version(cursor, view_user_id),
+            datetime.now().strftime('%Y-%m-%dT%H')
         )
-        raw_logs = cursor.fetchall()
-        logs = []
-        last_entry = None
-        for row in raw_logs:
-            dt_str = row[2].strftime('%Y-%m-%dT%H:%M:%S') if row[2] else None
-            logs.append({'id': row[0], 'user_id': row[1], 'log_time': dt_str})
-            if last_entry is None and row[2]:
-                today = datetime.now().date()
-                entry_date = row[2].date()
-                time_str = row[2].strftime('%H:%M')
-                if entry_date == today:
-                    last_entry = f"Avui: {time_str}"
-                elif entry_date == today - timedelta(days=1):
-                    last_entry = f"Ahir: {time_str}"
-                else:
-                    days_ago = (today - entry_date).days
-                    last_entry = f"Fa {days_ago} dies a les {time_str}"
-
-        conn.close()
+        if _not_modified(etag):
+            return '', 304, {'ETag': quote_etag(etag)}
 
-        return {
+        response = {
             'status': 'success',
             'users': public_users,
             'selected_user_id': view_user_id,
-            'logs': logs,
-            'last_entry': last_entry,
-        }, 200
+        }
+
+        if include_logs:
+            raw_logs, next_cursor = fetch_logs_page(
+                cursor, view_user_id, limit if paginate else None,
+                after=page_cursor, since=since, until=until
+            )
+            response['logs'] = [
+                {
+                    'id': row[0],
+                    'user_id': row[1],
+                    'log_time': row[2].strftime('%Y-%m-%dT%H:%M:%S') if row[2] else None,
+                }
+                for row in raw_logs
+            ]
+
+            if paginate:
+                response['next_cursor'] = next_cursor
+                # Only the first page pays for the count; clients keep it while paging
+                if not page_cursor:
+                    response['total'] = count_logs(cursor, view_user_id, since=since, until=until)
+
+            # The first unfiltered page already starts with the most recent entry
+            if raw_logs and not page_cursor and not until:
+                last_log = raw_logs[0][2]
+            else:
+                last_log = get_last_log_time(cursor, view_user_id)
+            response['last_entry'] = humanize_last_entry(last_log)
+        else:
+            summary = get_summary(cursor, view_user_id)
+            response['last_entry'] = humanize_last_entry(summary.pop('last_log'))
+            response['summary'] = summary
+
+        if series_views:
+            response['series'] = {view: get_series(cursor, view_user_id, view) for view in series_views}
+
+        return response, 200, {'ETag': quote_etag(etag)}
 
     except Exception as e:
         current_app.logger.error(f"Home API error: {e}")
         return {'error': str(e)}, 500
 
 
+# ── Incremental Sync ──────────────────────────────────────────────────────────
+
+@api_bp.route('/sync', methods=['GET', 'POST'])
+@api_auth_required
+def api_sync():
+    """
+    Return the viewed user's log changes since a watermark.
+    Pass the 'watermark' from the previous response (omit it for a full
+    sync) and 'view_user_id' to follow another user. Clients apply
+    'inserted' first, then remove the ids in 'deleted'. Both may repeat
+    recent changes the client already has, so apply them by id.
+    """
+    data = request.get_json(silent=True) or {}
+    view_user_id = data.get('view_user_id', g.api_user[0])
+    watermark = data.get('watermark')
+
+    try:
+        since_log_id, since_tombstone_id = (int(part) for part in watermark.split('.')) if watermark else (0, 0)
+    except (AttributeError, ValueError):
+        return {'error': 'Invalid watermark'}, 400
+
+    try:
+        cursor = get_read_db(view_user_id).cursor()
+
+        etag = _etag(view_user_id, watermark, get_log_version(cursor, view_user_id))
+        if _not_modified(etag):
+            return '', 304, {'ETag': quote_etag(etag)}
+
+        inserted, deleted = fetch_log_changes(cursor, view_user_id, since_log_id, since_tombstone_id)
+        next_log_id = max([since_log_id] + [row[0] for row in inserted])
+        next_tombstone_id = max([since_tombstone_id] + [row[0] for row in deleted])
+
+        return {
+            'status': 'success',
+            'selected_user_id': view_user_id,
+            'full': watermark is None,
+            'watermark': f"{next_log_id}.{next_tombstone_id}",
+            'inserted': [
+                {
+                    'id': row[0],
+                    'user_id': row[1],
+                    'log_time': row[2].strftime('%Y-%m-%dT%H:%M:%S') if row[2] else None,
+                }
+                for row in inserted
+            ],
+            'deleted': [row[1] for row in deleted],
+        }, 200, {'ETag': quote_etag(etag)}
+
+    except Exception as e:
+        current_app.logger.error(f"Sync error: {e}")
+        return {'error': str(e)}, 500
+
+
+# ── Live Updates ──────────────────────────────────────────────────────────────
+
+@api_bp.route('/events', methods=['GET'])
+@api_auth_required
+def api_events():
+    """
+    Server-Sent Events stream of the viewed user's log changes (see live.py).
+    Pass 'view_user_id' in the query string to follow another public user.
+    Apply 'log' events as they arrive; on 'resync', or after reconnecting,
+    catch up through /api/sync.
+    """
+    if not LIVE_UPDATES_ENABLED:
+        return {'error': 'Live updates are not enabled'}, 404
+    my_id = g.api_user[0]
+    view_user_id = request.args.get('view_user_id', my_id, type=int)
+
+    try:
+        if not can_watch(view_user_id, my_id):
+            return {'error': 'User not found'}, 404
+    except Exception as e:
+        current_app.logger.error(f"Events error: {e}")
+        return {'error': str(e)}, 500
+    return event_stream(view_user_id)
+
+
+# ── Export ─────────────────────────────────────────────────────────────────────
+
+EXPORT_FORMATS = {
+    'jsonl': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+# Rows per chunk written to the client; small enough that the first bytes go out at once
+EXPORT_CHUNK_ROWS = 256
+
+
+def _export_lines(rows, fmt):
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(['id', 'log_time'])
+        for n, (log_id, log_time) in enumerate(rows, 1):
+            writer.writerow([log_id, log_time.strftime('%Y-%m-%dT%H:%M:%S')])
+            if n % EXPORT_CHUNK_ROWS == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+    else:
+        chunk = []
+        for log_id, log_time in rows:
+            chunk.append(json.dumps({'id': log_id, 'log_time': log_time.strftime('%Y-%m-%dT%H:%M:%S')}))
+            if len(chunk) == EXPORT_CHUNK_ROWS:
+                yield '\n'.join(chunk) + '\n'
+                chunk = []
+        if chunk:
+            yield '\n'.join(chunk) + '\n'
+
+
+@api_bp.route('/export', methods=['GET', 'POST'])
+@api_auth_required
+def api_export():
+    """
+    Stream the caller's full log history, oldest first, as JSON lines
+    ('format': 'jsonl', the default) or CSV ('format': 'csv').
+    'since'/'until' (ISO datetimes) restrict the log_time range. Parameters
+    may come from the query string or the JSON body.
+
+    Rows are read from a server-side cursor in EXPORT_ITERSIZE batches and
+    written out as they arrive, so memory use stays flat however long the
+    history is.
+    """
+    data = {**(request.get_json(silent=True) or {}), **request.args.to_dict()}
+    fmt = data.get('format', 'jsonl')
+    if fmt not in EXPORT_FORMATS:
+        return {'error': f"format must be one of: {', '.join(EXPORT_FORMATS)}"}, 400
+    try:
+        since = datetime.fromisoformat(data['since']) if data.get('since') else None
+        until = datetime.fromisoformat(data['until']) if data.get('until') else None
+    except (TypeError, ValueError) as e:
+        return {'error': f'Invalid range: {e}'}, 400
+
+    user_id = g.api_user[0]
+    try:
+        conn = get_read_db(user_id)
+    except Exception as e:
+        current_app.logger.error(f"Export error: {e}")
+        return {'error': str(e)}, 500
+
+    def generate():
+        # The request's connection stays checked out until the last row is sent
+        try:
+            yield from _export_lines(iter_logs(conn, user_id, since, until, EXPORT_ITERSIZE), fmt)
+        except Exception as e:
+            # Headers are already sent; all we can do is cut the stream short
+            current_app.logger.error(f"Export error after streaming started: {e}")
+
+    filename = f"poop-export-{user_id}.{fmt}"
+    return Response(
+        stream_with_context(generate()),
+        mimetype=EXPORT_FORMATS[fmt],
+        headers={
+            'Content-Disposition': f'attachment; filename="{filename}"',
+            'X-Accel-Buffering': 'no',
+        }
+    )
+
+
 # ── User Privacy ───────────────────────────────────────────────────────────────
 
 @api_bp.route('/user/privacy', methods=['POST'])
+@api_auth_required
 def api_get_privacy():
     """Return the user's current privacy setting."""
-    data = request.get_json()
-    user_data, err = _authenticate(data)
-    if err:
-        return err
-
-    config = {}
-    if user_data[4]:
-        config = json.loads(user_data[4]) if isinstance(user_data[4], str) else user_data[4]
+    user_data = g.api_user
+
+    config = parse_config(user_data[4])
+    if g.api_token:
+        # Token requests carry no config; read the current setting
+        try:
+            cursor = get_db().cursor()
+            cursor.execute("SELECT config FROM users WHERE id = %s", (user_data[0],))
+            row = cursor.fetchone()
+            config = parse_config(row[0] if row else None)
+        except Exception as e:
+            current_app.logger.error(f"Privacy lookup error: {e}")
+            return {'error': str(e)}, 500
 
     return {
         'status': 'success',
@@ -211,24 +493,25 @@ def api_get_privacy():
 
 
 @api_bp.route('/user/privacy/update', methods=['POST'])
+@api_auth_required
 def api_update_privacy():
     """Update the user's privacy setting."""
-    data = request.get_json()
-    user_data, err = _authenticate(data)
-    if err:
-        return err
+    data = request.get_json(silent=True) or {}
+    user_data = g.api_user
 
     new_privacy = data.get('privacy')
     if new_privacy not in ('public', 'private'):
         return {'error': 'privacy must be "public" or "private"'}, 400
 
     try:
-        conn = get_db_connection()
+        conn = get_db()
         cursor = conn.cursor()
         sql = "UPDATE users SET config = jsonb_set(config::jsonb, '{public}', %s::jsonb) WHERE id = %s"
         cursor.execute(sql, ('true' if new_privacy == 'public' else 'false', user_data[0]))
         conn.commit()
-        conn.close()
+        invalidate_user_credentials(user_data[0])
+        invalidate_user(user_data[0])
+        invalidate_public_users()
 
         return {'status': 'success', 'privacy': new_privacy}, 200
 
@@ -240,24 +523,25 @@ def api_update_privacy():
 # ── Delete Poop Entry ─────────────────────────────────────────────────────────
 
 @api_bp.route('/poop/delete', methods=['POST'])
+@api_auth_required
 def api_poop_delete():
     """Delete a poop entry by ID (only owner can delete)."""
-    data = request.get_json()
-    user_data, err = _authenticate(data)
-    if err:
-        return err
+    data = request.get_json(silent=True) or {}
+    user_data = g.api_user
 
     entry_id = data.get('entry_id')
     if not entry_id:
         return {'error': 'entry_id is required'}, 400
 
     try:
-        conn = get_db_connection()
+        conn = get_db()
         cursor = conn.cursor()
-        cursor.execute("DELETE FROM poop WHERE id = %s AND user_id = %s", (entry_id, user_data[0]))
-        deleted = cursor.rowcount
+        deleted = delete_log(cursor, user_data[0], entry_id)
+        if deleted:
+            notify_log_changes(cursor, user_data[0], deleted=[entry_id])
         conn.commit()
-        conn.close()
+        if deleted:
+            invalidate_user_data(user_data[0])
 
         if deleted == 0:
             return {'error': 'Entry not found or not owned by user'}, 404
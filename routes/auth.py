@@ -1,10 +1,11 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app
 from flask_login import login_user, login_required, logout_user, current_user
-from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
 import json
 
-from models import User, get_user_by_email, get_db_connection
+from db import get_db
+from hashing import HashPoolBusy, RETRY_AFTER, hash_password, verify_password
+from models import User, get_user_by_email, invalidate_public_users
 
 auth_bp = Blueprint('auth', __name__)
 
@@ -18,13 +19,17 @@ def login():
         try:
             user_data = get_user_by_email(email)
 
-            if user_data and check_password_hash(user_data[3], password):
+            if user_data and verify_password(user_data[3], password):
                 user = User(user_data[0], user_data[2], user_data[1], user_data[4])
                 login_user(user, remember=True)
                 flash('Has iniciat sessió correctament!', 'success')
                 return redirect(url_for('poop.poop', _external=True))
             else:
                 flash('Correu electrònic o contrasenya incorrectes', 'error')
+        except HashPoolBusy as e:
+            current_app.logger.warning(f"Login rejected: {e}")
+            flash("El servidor està ocupat, torna-ho a provar d'aquí a uns segons", 'error')
+            return render_template('login.html'), 503, {'Retry-After': str(RETRY_AFTER)}
         except Exception as e:
             current_app.logger.error(f"Login error: {e}")
             flash(f"Error d'inici de sessió: {e}", 'error')
@@ -57,18 +62,17 @@ def register():
             return render_template('register.html')
 
         try:
-            conn = get_db_connection()
+            conn = get_db()
             cursor = conn.cursor()
 
             # Check if user already exists
             cursor.execute("SELECT id FROM users WHERE email = %s", (email,))
             if cursor.fetchone():
-                conn.close()
                 flash('Email already exists', 'error')
                 return render_template('register.html')
 
             # Create new user
-            password_hash = generate_password_hash(password)
+            password_hash = hash_password(password)
             created_at = datetime.now()
             config_json = json.dumps({"public": privacy == "public"})
             cursor.execute(
@@ -76,11 +80,16 @@ def register():
                 (username, email, password_hash, config_json, created_at)
             )
             conn.commit()
-            conn.close()
+            if privacy == "public":
+                invalidate_public_users()
 
             flash('Account created successfully! Please log in.', 'success')
             return redirect(url_for('auth.login'))
 
+        except HashPoolBusy as e:
+            current_app.logger.warning(f"Registration rejected: {e}")
+            flash('Server busy, please try again in a few seconds', 'error')
+            return render_template('register.html'), 503, {'Retry-After': str(RETRY_AFTER)}
         except Exception as e:
             current_app.logger.error(f"Registration error: {e}")
             flash(f"Registration error: {e}", 'error')
@@ -1,18 +1,44 @@
-from flask import Blueprint, render_template, request, flash, current_app
+from flask import Blueprint, Response, render_template, request, flash, current_app
 from flask_login import current_user
-from datetime import datetime, timedelta
+from datetime import date, datetime, timezone
+import hashlib
 
-from models import get_db_connection
+from cache import get_shared_backend
+from config import CROSS_WORKER_CACHES, HOME_PAGE_CACHE_TTL, HOME_PAGE_MAX_AGE, LIVE_UPDATES_ENABLED
+from db import get_read_db, reading_from_replica
+from live import can_watch, event_stream
+from models import get_public_users, get_user_data_version, peek_public_users, remember_public_users
+from stats import SERIES_VIEWS, get_series, get_summary, humanize_last_entry
 
 main_bp = Blueprint('main', __name__)
 
 
+def _home_cache_key(selected_user_id, public_users_version):
+    """
+    Cache key for an anonymous render of a public dashboard. It changes
+    whenever the user's logs or the public directory change, on deploys that
+    change an asset URL, and daily, since the stats and "last entry" text
+    are relative to today.
+    """
+    return 'page:home:{}:{}:{}:{}:{}'.format(
+        selected_user_id, get_user_data_version(selected_user_id), public_users_version,
+        current_app.extensions['assets'].version, date.today().isoformat()
+    )
+
+
+def _cached_page_response(entry):
+    """Build a conditional response (304 when the client's copy is current) from a cached entry."""
+    response = Response(entry['html'], mimetype='text/html')
+    response.set_etag(entry['etag'])
+    response.last_modified = entry['last_modified']
+    response.cache_control.public = True
+    response.cache_control.max_age = HOME_PAGE_MAX_AGE
+    response.vary.add('Cookie')
+    return response.make_conditional(request)
+
+
 @main_bp.route('/')
 def home():
-    current_app.logger.info('Home page accessed')
-    user_ip = request.remote_addr
-    current_app.logger.info(f'User IP: {user_ip}')
-
     # Check if the user is logged in and prioritize their ID unless a new user_id is explicitly provided
     selected_user_id = request.args.get('user_id', type=int)
     if not selected_user_id and current_user.is_authenticated:
@@ -20,69 +46,54 @@ def home():
     elif not selected_user_id:
         selected_user_id = 1
 
-    formatted_logs = []
+    # Anonymous visits to a public profile are all identical, so they are
+    # served from the shared cache without touching the database (only with
+    # a cache every worker shares, so a new entry invalidates them all)
+    cache_key = None
+    if CROSS_WORKER_CACHES and not current_user.is_authenticated:
+        version, public_users = peek_public_users()
+        if public_users is not None and any(user[0] == selected_user_id for user in public_users):
+            try:
+                cache_key = _home_cache_key(selected_user_id, version)
+                entry = get_shared_backend().get(cache_key)
+                if entry is not None:
+                    return _cached_page_response(entry)
+            except Exception as e:
+                current_app.logger.warning(f"Page cache unavailable: {e}")
+                cache_key = None
+
     users = []
+    summary = None
     last_entry_date = None
+    rendered_ok = False
 
     try:
-        conn = get_db_connection()
+        conn = get_read_db(selected_user_id)
         cursor = conn.cursor()
 
-        # Fetch all public accounts
-        cursor.execute(
-            "SELECT id, username, email FROM users WHERE (config->>'public')::boolean = true ORDER BY id ASC"
-        )
-        users = cursor.fetchall()
+        # Headline stats, including the last entry, in one round trip; on the
+        # primary it also fetches the public accounts when they aren't cached
+        # (a replica's copy may predate a privacy change, so it isn't cached).
+        # Chart series are fetched separately by home.js.
+        version, public_users = peek_public_users()
+        fold_public_users = public_users is None and not reading_from_replica()
+        summary = get_summary(cursor, selected_user_id, with_public_users=fold_public_users)
+        if fold_public_users:
+            public_users = remember_public_users(version, summary.pop('public_users'))
+        elif public_users is None:
+            public_users = get_public_users()
+        last_entry_date = humanize_last_entry(summary.pop('last_log'))
+
+        users = list(public_users)
 
         # If user is logged in and their account is private, add their own account to the list
-        if current_user.is_authenticated:
-            cursor.execute(
-                "SELECT config->>'public' FROM users WHERE id = %s",
-                (current_user.id,)
-            )
-            privacy_result = cursor.fetchone()
-
-            # If the user's account is private, add it to the users list
-            if privacy_result and privacy_result[0] == 'false':
-                cursor.execute(
-                    "SELECT id, username, email FROM users WHERE id = %s",
-                    (current_user.id,)
-                )
-                user_data = cursor.fetchone()
-                if user_data and user_data not in users:
-                    users.append(user_data)
-
-        sql = "SELECT id, user_id, log_time FROM poop WHERE user_id = %s ORDER BY log_time DESC"
-        cursor.execute(sql, (selected_user_id,))
-        raw_logs = cursor.fetchall()
-
-        for row in raw_logs:
-            log_id = row[0]
-            u_id = row[1]
-            dt_obj = row[2]
-
-            clean_date = None
-            if dt_obj:
-                clean_date = dt_obj.strftime('%Y-%m-%dT%H:%M:%S')
-
-            formatted_logs.append([log_id, u_id, clean_date])
-
-            # Set last_entry_date on first iteration (most recent)
-            if last_entry_date is None and dt_obj:
-                # Format date in a visual way (Today, Yesterday, etc.)
-                today = datetime.now().date()
-                entry_date = dt_obj.date()
-                time_str = dt_obj.strftime('%H:%M')
-
-                if entry_date == today:
-                    last_entry_date = f"Avui: {time_str}"
-                elif entry_date == today - timedelta(days=1):
-                    last_entry_date = f"Ahir: {time_str}"
-                else:
-                    days_ago = (today - entry_date).days
-                    last_entry_date = f"Fa {days_ago} dies a les {time_str}"
-
-        conn.close()
+        # (the user loader already fetched their config, so no extra queries are needed)
+        if current_user.is_authenticated and not current_user.is_public:
+            user_data = (current_user.id, current_user.username)
+            if user_data not in users:
+                users.append(user_data)
+
+        rendered_ok = True
 
     except Exception as e:
         current_app.logger.error(f"Database error on home: {e}")
@@ -90,11 +101,67 @@ def home():
 
     user_is_logged_in = current_user.is_authenticated
 
-    return render_template(
+    html = render_template(
         'home.html',
-        logs=formatted_logs,
+        summary=summary,
         users=users,
         selected_user_id=selected_user_id,
         user_is_logged_in=user_is_logged_in,
-        last_entry_date=last_entry_date
+        last_entry_date=last_entry_date,
+        live_updates=LIVE_UPDATES_ENABLED
     )
+
+    if cache_key is None or not rendered_ok:
+        response = Response(html, mimetype='text/html')
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+
+    entry = {
+        'html': html,
+        'etag': hashlib.sha1(cache_key.encode('utf-8')).hexdigest(),
+        'last_modified': datetime.now(timezone.utc).replace(microsecond=0),
+    }
+    try:
+        get_shared_backend().set(cache_key, entry, ttl=HOME_PAGE_CACHE_TTL)
+    except Exception as e:
+        current_app.logger.warning(f"Page cache unavailable: {e}")
+    return _cached_page_response(entry)
+
+
+@main_bp.route('/series')
+def series():
+    """Pre-bucketed chart data for the dashboard (see stats.get_series)."""
+    user_id = request.args.get('user_id', type=int)
+    view = request.args.get('view', 'last30')
+    offset = request.args.get('offset', 0, type=int)
+
+    if not user_id:
+        return {'error': 'user_id is required'}, 400
+    if view not in SERIES_VIEWS:
+        return {'error': f"view must be one of: {', '.join(SERIES_VIEWS)}"}, 400
+
+    try:
+        cursor = get_read_db(user_id).cursor()
+        return get_series(cursor, user_id, view, offset), 200
+    except Exception as e:
+        current_app.logger.error(f"Series error: {e}")
+        return {'error': str(e)}, 500
+
+
+@main_bp.route('/events')
+def events():
+    """Live updates for the dashboard (see live.py); home.js redraws on each event."""
+    if not LIVE_UPDATES_ENABLED:
+        return {'error': 'Live updates are not enabled'}, 404
+    user_id = request.args.get('user_id', type=int)
+    if not user_id:
+        return {'error': 'user_id is required'}, 400
+
+    try:
+        if not can_watch(user_id, current_user.id if current_user.is_authenticated else None):
+            return {'error': 'User not found'}, 404
+    except Exception as e:
+        current_app.logger.error(f"Events error: {e}")
+        return {'error': str(e)}, 500
+    return event_stream(user_id)
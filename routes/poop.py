@@ -1,9 +1,12 @@
-from flask import Blueprint, render_template, request, flash, current_app
+from flask import Blueprint, render_template, request, flash, current_app, g
 from flask_login import login_required, current_user
-from werkzeug.security import check_password_hash
 from datetime import datetime
 
-from models import get_db_connection
+from api_auth import api_auth_required
+from config import API_BATCH_MAX_ENTRIES, IDEMPOTENCY_KEY_MAX_LENGTH
+from db import get_db, get_read_db
+from ingest import IngestError, IngestPending, IngestQueueFull, ingest_enabled, submit_log
+from models import insert_log, insert_logs_batch, get_last_log_time, invalidate_user_data, notify_log_changes
 
 poop_bp = Blueprint('poop', __name__)
 
@@ -15,19 +18,30 @@ def poop():
         user_date = request.form['user_time']
 
         try:
-            conn = get_db_connection()
-            cursor = conn.cursor()
-
-            sql = "INSERT INTO poop (user_id, log_time) VALUES (%s, %s)"
-            cursor.execute(sql, (current_user.id, user_date))
-            conn.commit()
-            conn.close()
-
-            formatted_date = datetime.strptime(user_date, '%Y-%m-%dT%H:%M').strftime('%d/%m/%Y %H:%M')
+            log_time = datetime.strptime(user_date, '%Y-%m-%dT%H:%M')
+            if ingest_enabled():
+                submit_log(current_user.id, log_time)
+            else:
+                conn = get_db()
+                cursor = conn.cursor()
+
+                log_id = insert_log(cursor, current_user.id, log_time)
+                notify_log_changes(cursor, current_user.id, inserted=[(log_id, log_time)])
+                conn.commit()
+                invalidate_user_data(current_user.id)
+
+            formatted_date = log_time.strftime('%d/%m/%Y %H:%M')
             flash(f'<strong>Èxit!</strong> Registre afegit correctament: <em>{formatted_date}</em>', 'success')
 
             return "OK", 200
 
+        except IngestQueueFull as e:
+            flash("<strong>Error!</strong> El servidor està ocupat, torna-ho a provar d'aquí a uns segons.", 'error')
+            return str(e), 503, {'Retry-After': '1'}
+        except IngestPending as e:
+            current_app.logger.warning(f"Poop entry pending: {e}")
+            flash("<strong>Atenció!</strong> El registre s'està desant; comprova-ho d'aquí a uns segons abans de tornar-lo a afegir.", 'info')
+            return str(e), 202
         except Exception as e:
             flash(f"<strong>Error!</strong> Hi ha hagut un problema amb la base de dades: <em>{e}</em>", 'error')
             return str(e), 500
@@ -36,133 +50,195 @@ def poop():
 
 
 @poop_bp.route('/api/poop', methods=['POST'])
+@api_auth_required
 def api_poop():
-    """API endpoint to create a poop entry with credentials in JSON data"""
+    """API endpoint to create a poop entry (Bearer token or credentials in JSON data)"""
     try:
-        data = request.get_json()
+        data = request.get_json(silent=True) or {}
 
         # Validate required fields
-        if not data or 'email' not in data or 'password' not in data or 'user_time' not in data:
-            return {'error': 'email, password, and user_time are required'}, 400
+        if 'user_time' not in data:
+            return {'error': 'user_time is required'}, 400
 
-        email = data['email']
-        password = data['password']
         user_date = data['user_time']
 
         # Validate date format
         try:
-            datetime.strptime(user_date, '%Y-%m-%dT%H:%M')
+            log_time = datetime.strptime(user_date, '%Y-%m-%dT%H:%M')
         except ValueError:
             return {'error': 'Invalid date format. Use YYYY-MM-DDTHH:MM'}, 400
 
-        # Authenticate user
-        try:
-            conn = get_db_connection()
+        user_id = g.api_user[0]
+
+        # Insert poop entry (or queue it, see ingest.py)
+        if ingest_enabled():
+            submit_log(user_id, log_time)
+        else:
+            conn = get_db()
             cursor = conn.cursor()
-            cursor.execute(
-                "SELECT id, username, email, password_hash FROM users WHERE email = %s",
-                (email,)
-            )
-            user_data = cursor.fetchone()
+            log_id = insert_log(cursor, user_id, log_time)
+            notify_log_changes(cursor, user_id, inserted=[(log_id, log_time)])
+            conn.commit()
+            invalidate_user_data(user_id)
+
+        formatted_date = log_time.strftime('%d/%m/%Y %H:%M')
+
+        return {
+            'status': 'success',
+            'message': f'Registre afegit correctament: {formatted_date}',
+            'timestamp': formatted_date,
+            'user_id': user_id
+        }, 201
+
+    except IngestQueueFull as e:
+        current_app.logger.warning(f"API poop rejected: {e}")
+        return {'error': 'Server busy, try again shortly'}, 503, {'Retry-After': '1'}
+    except IngestPending as e:
+        # Not an error: the entry may still be saved, so retrying could duplicate it
+        current_app.logger.warning(f"API poop pending: {e}")
+        return {
+            'status': 'pending',
+            'message': 'Entry accepted but not saved yet; check before sending it again',
+        }, 202
+    except IngestError as e:
+        current_app.logger.error(f"API poop ingestion error: {e}")
+        return {'error': str(e)}, 500
+    except Exception as e:
+        current_app.logger.error(f"API poop error: {e}")
+        return {'error': str(e)}, 500
 
-            if not user_data or not check_password_hash(user_data[3], password):
-                conn.close()
-                return {'error': 'Invalid email or password'}, 401
 
-            user_id = user_data[0]
+def _validate_batch_entry(entry, seen_keys):
+    """Return (idempotency_key, log_time) for a batch entry, or raise ValueError."""
+    if not isinstance(entry, dict):
+        raise ValueError('Entry must be an object')
 
-            # Insert poop entry
-            sql = "INSERT INTO poop (user_id, log_time) VALUES (%s, %s)"
-            cursor.execute(sql, (user_id, user_date))
-            conn.commit()
-            conn.close()
+    key = entry.get('idempotency_key')
+    if not isinstance(key, str) or not key:
+        raise ValueError('idempotency_key is required')
+    if len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+        raise ValueError(f'idempotency_key is longer than {IDEMPOTENCY_KEY_MAX_LENGTH} characters')
+    if key in seen_keys:
+        raise ValueError('Duplicate idempotency_key in batch')
+
+    if 'user_time' not in entry:
+        raise ValueError('user_time is required')
+    try:
+        log_time = datetime.strptime(entry['user_time'], '%Y-%m-%dT%H:%M')
+    except (TypeError, ValueError):
+        raise ValueError('Invalid date format. Use YYYY-MM-DDTHH:MM')
 
-            formatted_date = datetime.strptime(user_date, '%Y-%m-%dT%H:%M').strftime('%d/%m/%Y %H:%M')
+    return key, log_time
 
-            return {
-                'status': 'success',
-                'message': f'Registre afegit correctament: {formatted_date}',
-                'timestamp': formatted_date,
-                'user_id': user_id
-            }, 201
 
-        except Exception as e:
-            current_app.logger.error(f"API poop authentication error: {e}")
-            return {'error': 'Authentication failed'}, 401
+@poop_bp.route('/api/poop/batch', methods=['POST'])
+@api_auth_required
+def api_poop_batch():
+    """
+    API endpoint to create many poop entries at once, e.g. a mobile client's
+    offline queue. Each entry carries a client-generated idempotency_key, so
+    a retried batch never creates duplicates.
+
+    Body: {"entries": [{"idempotency_key": "...", "user_time": "YYYY-MM-DDTHH:MM"}, ...]}
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        entries = data.get('entries')
+
+        if not isinstance(entries, list) or not entries:
+            return {'error': 'entries must be a non-empty list'}, 400
+        if len(entries) > API_BATCH_MAX_ENTRIES:
+            return {'error': f'At most {API_BATCH_MAX_ENTRIES} entries per batch'}, 400
+
+        # Validate everything before touching the database
+        validated = []
+        errors = []
+        seen_keys = set()
+        for index, entry in enumerate(entries):
+            try:
+                key, log_time = _validate_batch_entry(entry, seen_keys)
+            except ValueError as e:
+                errors.append({'index': index, 'error': str(e)})
+                continue
+            seen_keys.add(key)
+            validated.append((key, log_time))
+
+        if errors:
+            return {'error': 'Invalid entries', 'errors': errors}, 400
+
+        user_id = g.api_user[0]
+
+        conn = get_db()
+        cursor = conn.cursor()
+        inserted = insert_logs_batch(cursor, user_id, validated)
+        notify_log_changes(cursor, user_id, inserted=[
+            (inserted[key][0], log_time) for key, log_time in validated if inserted[key][1]
+        ])
+        conn.commit()
+        if any(created for _, created in inserted.values()):
+            invalidate_user_data(user_id)
+
+        results = []
+        for key, _ in validated:
+            log_id, created = inserted[key]
+            results.append({
+                'idempotency_key': key,
+                'id': log_id,
+                'status': 'created' if created else 'duplicate',
+            })
+
+        return {
+            'status': 'success',
+            'user_id': user_id,
+            'created': sum(1 for r in results if r['status'] == 'created'),
+            'results': results
+        }, 200
 
     except Exception as e:
-        current_app.logger.error(f"API poop error: {e}")
+        current_app.logger.error(f"API poop batch error: {e}")
         return {'error': str(e)}, 500
 
 
 @poop_bp.route('/api/poop/metrics', methods=['GET'])
+@api_auth_required
 def api_poop_metrics():
     """API endpoint to get metrics AND the exact last entry time"""
     try:
-        data = request.get_json()
-
-        if not data or 'email' not in data or 'password' not in data:
-            return {'error': 'email and password are required'}, 400
-
-        email = data['email']
-        password = data['password']
-
-        try:
-            conn = get_db_connection()
-            cursor = conn.cursor()
-
-            # 1. Login
-            cursor.execute(
-                "SELECT id, username, email, password_hash FROM users WHERE email = %s",
-                (email,)
-            )
-            user_data = cursor.fetchone()
-
-            if not user_data or not check_password_hash(user_data[3], password):
-                conn.close()
-                return {'error': 'Invalid email or password'}, 401
-
-            user_id = user_data[0]
-
-            # 2. Metrics
-            sql_metrics = """
-                SELECT DATE(log_time) as date, COUNT(*) as count
-                FROM poop
-                WHERE user_id = %s AND log_time >= NOW() - INTERVAL '7 days'
-                GROUP BY DATE(log_time)
-                ORDER BY date DESC
-            """
-            cursor.execute(sql_metrics, (user_id,))
-            metrics_data = cursor.fetchall()
-
-            # 3. Get exact time of last entry
-            sql_last = "SELECT log_time FROM poop WHERE user_id = %s ORDER BY log_time DESC LIMIT 1"
-            cursor.execute(sql_last, (user_id,))
-            last_row = cursor.fetchone()
-
-            last_entry_str = "Sin datos"
-            if last_row:
-                last_entry_str = str(last_row[0])
-
-            conn.close()
-
-            # Totals
-            total_entries = sum(row[1] for row in metrics_data)
-            daily_metrics = [{'date': str(row[0]), 'count': row[1]} for row in metrics_data]
-
-            return {
-                'status': 'success',
-                'user_id': user_id,
-                'username': user_data[1],
-                'total_last_7_days': total_entries,
-                'average_per_day': round(total_entries / 7, 2),
-                'daily_breakdown': daily_metrics,
-                'last_entry': last_entry_str
-            }, 200
-
-        except Exception as e:
-            current_app.logger.error(f"Authentication error: {e}")
-            return {'error': 'Authentication failed'}, 401
+        user_data = g.api_user
+        user_id = user_data[0]
+
+        cursor = get_read_db(user_id).cursor()
+
+        # 1. Metrics (from the daily rollup)
+        sql_metrics = """
+            SELECT day as date, count
+            FROM poop_daily
+            WHERE user_id = %s AND day > CURRENT_DATE - 7
+            ORDER BY day DESC
+        """
+        cursor.execute(sql_metrics, (user_id,))
+        metrics_data = cursor.fetchall()
+
+        # 2. Get exact time of last entry
+        last_log = get_last_log_time(cursor, user_id)
+
+        last_entry_str = "Sin datos"
+        if last_log:
+            last_entry_str = str(last_log)
+
+        # Totals
+        total_entries = sum(row[1] for row in metrics_data)
+        daily_metrics = [{'date': str(row[0]), 'count': row[1]} for row in metrics_data]
+
+        return {
+            'status': 'success',
+            'user_id': user_id,
+            'username': user_data[1],
+            'total_last_7_days': total_entries,
+            'average_per_day': round(total_entries / 7, 2),
+            'daily_breakdown': daily_metrics,
+            'last_entry': last_entry_str
+        }, 200
 
     except Exception as e:
         current_app.logger.error(f"API error: {e}")
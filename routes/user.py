@@ -1,7 +1,9 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app
 from flask_login import login_required, current_user
 
-from models import get_db_connection
+from api_auth import invalidate_user_credentials
+from db import get_db
+from models import invalidate_public_users, invalidate_user
 
 user_bp = Blueprint('user', __name__)
 
@@ -17,14 +19,16 @@ def user():
             return redirect(url_for('user.user'))
 
         try:
-            conn = get_db_connection()
+            conn = get_db()
             cursor = conn.cursor()
 
             # Update the user's privacy setting
             sql = "UPDATE users SET config = jsonb_set(config::jsonb, '{public}', %s::jsonb) WHERE id = %s"
             cursor.execute(sql, ('true' if new_privacy == 'public' else 'false', current_user.id))
             conn.commit()
-            conn.close()
+            invalidate_user_credentials(current_user.id)
+            invalidate_user(current_user.id)
+            invalidate_public_users()
 
             flash('La configuració de privacitat s\'ha actualitzat correctament.', 'success')
         except Exception as e:
@@ -33,19 +37,7 @@ def user():
 
         return redirect(url_for('user.user'))
 
-    # Fetch the current privacy setting
-    user_privacy = 'private'
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        sql = "SELECT config->>'public' FROM users WHERE id = %s"
-        cursor.execute(sql, (current_user.id,))
-        result = cursor.fetchone()
-        conn.close()
-
-        if result and result[0] == 'true':
-            user_privacy = 'public'
-    except Exception as e:
-        current_app.logger.error(f"Error fetching privacy setting: {e}")
+    # The current privacy setting was loaded along with the user
+    user_privacy = 'public' if current_user.is_public else 'private'
 
     return render_template('user.html', user_privacy=user_privacy)
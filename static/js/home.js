@@ -1,134 +1,16 @@
 document.addEventListener('DOMContentLoaded', function() {
 
-    // ================= CONFIGURATION =================
-    const SMOOTHING_WINDOWS = {
-        last30: 3,    
-        last365: 7,   
-        monthly: 1,   
-        yearly: 1     
-    };
-    // =================================================
-
-    // --- 1. PREP DATA ---
-    function parseAsDatabaseTime(dateString) {
-        if (!dateString) return null;
-        
-        // The input is now "2026-01-21T21:52:00"
-        // When we do new Date("..."), the browser treats this ISO format (without Z) 
-        // as "Local Browser Time". 
-        // So 21:52 becomes 21:52 on the user's clock. Perfect.
-        const d = new Date(dateString);
-        
-        // We still need to create a UTC object for the chart logic to work 
-        // consistently across the rest of your script
-        return new Date(Date.UTC(
-            d.getFullYear(),
-            d.getMonth(),
-            d.getDate(),
-            d.getHours(),
-            d.getMinutes(),
-            d.getSeconds()
-        ));
-    }
-
-    // Apply the helper
-    const allDates = logs.map(row => parseAsDatabaseTime(row[2])).filter(d => d);
-    const timestamps = allDates.map(d => d.getTime());
-
-    // ... rest of the code ...
-    
-    // --- 2. MATH HELPERS (STRICT UTC) ---
-
-    function getDayOfYearUTC(date) {
-        const start = new Date(Date.UTC(date.getUTCFullYear(), 0, 0));
-        const diff = date - start;
-        const oneDay = 1000 * 60 * 60 * 24;
-        return Math.floor(diff / oneDay);
-    }
-
-    function getDaysActive(dateObj, type) {
-        const now = new Date();
-        const isCurrentYear = dateObj.getUTCFullYear() === now.getUTCFullYear();
-        const isCurrentMonth = isCurrentYear && dateObj.getUTCMonth() === now.getUTCMonth();
-
-        if (type === 'year') {
-            if (isCurrentYear) return getDayOfYearUTC(now);
-            const year = dateObj.getUTCFullYear();
-            return ((year % 4 === 0 && year % 100 > 0) || year % 400 === 0) ? 366 : 365;
-        }
-
-        if (type === 'month') {
-            if (isCurrentMonth) return now.getUTCDate();
-            return new Date(Date.UTC(dateObj.getUTCFullYear(), dateObj.getUTCMonth() + 1, 0)).getUTCDate();
-        }
-        return 1;
-    }
-
-    function calculateMovingAverage(data, windowSize) {
-        if (windowSize <= 1) return data; 
-        
-        let result = [];
-        for (let i = 0; i < data.length; i++) {
-            const start = Math.max(0, i - windowSize + 1);
-            const subset = data.slice(start, i + 1);
-            const sum = subset.reduce((a, b) => a + b, 0);
-            result.push(sum / subset.length);
-        }
-        return result;
-    }
-
+    // --- 1. DASHBOARD STATS (computed server-side) ---
     function updateDashboardStats() {
-        const now = new Date();
-        const oneDayMs = 1000 * 60 * 60 * 24;
+        if (!summary) return;
 
-        // 1. Total Logs
-        const totalCount = allDates.length;
-        document.getElementById('statTotal').textContent = totalCount.toLocaleString();
+        document.getElementById('statTotal').textContent = summary.total.toLocaleString();
+        document.getElementById('statAvg30').textContent = summary.avg_30.toFixed(2);
+        document.getElementById('statAvg365').textContent = summary.avg_365.toFixed(2);
+        document.getElementById('statAvgEver').textContent = summary.avg_ever.toFixed(2);
 
-        // Helper: Count logs within the last X days
-        function getCountInWindow(days) {
-            const cutoff = new Date(now.getTime() - (days * oneDayMs));
-            return allDates.filter(d => d >= cutoff).length;
-        }
-
-        // 2. Avg / Day (Last 30 Days)
-        const count30 = getCountInWindow(30);
-        document.getElementById('statAvg30').textContent = (count30 / 30).toFixed(2);
-
-        // 3. Avg / Day (Last 365 Days)
-        const count365 = getCountInWindow(365);
-        document.getElementById('statAvg365').textContent = (count365 / 365).toFixed(2);
-
-        // 4. Avg / Day (Ever)
-        if (timestamps.length > 0) {
-            const firstDate = new Date(Math.min(...timestamps));
-            const daysDiff = (now - firstDate) / oneDayMs;
-            const daysActive = Math.max(1, Math.floor(daysDiff)); 
-            document.getElementById('statAvgEver').textContent = (totalCount / daysActive).toFixed(2);
-        } else {
-            document.getElementById('statAvgEver').textContent = "0.00";
-        }
-
-        // 5. Peak Hour (Last 30 Days Only)
-        const cutoff30 = new Date(now.getTime() - (30 * oneDayMs));
-        const logsLast30 = allDates.filter(d => d >= cutoff30);
-
-        if (logsLast30.length > 0) {
-            const hourCounts = {};
-            logsLast30.forEach(d => {
-                const hour = d.getUTCHours(); // UPDATED: Use UTC Hours
-                hourCounts[hour] = (hourCounts[hour] || 0) + 1;
-            });
-
-            let maxHour = 0;
-            let maxCount = 0;
-            for (const [hour, count] of Object.entries(hourCounts)) {
-                if (count > maxCount) {
-                    maxCount = count;
-                    maxHour = hour;
-                }
-            }
-            const hourStr = maxHour.toString().padStart(2, '0');
+        if (summary.peak_hour !== null) {
+            const hourStr = summary.peak_hour.toString().padStart(2, '0');
             document.getElementById('statPeakHour').textContent = `${hourStr}:00`;
         } else {
             document.getElementById('statPeakHour').textContent = "-";
@@ -137,194 +19,69 @@ document.addEventListener('DOMContentLoaded', function() {
 
     updateDashboardStats();
 
-    // --- 3. DATA LOGIC ENGINE ---
+    // --- 2. DATA LOGIC ENGINE ---
+    // Buckets and moving averages come pre-computed from /series
     let myChart = null; 
     let currentOffset = 0; 
+    let latestRequest = 0;
 
-    function getDataForView(viewType, offset) {
-        const counts = {}; 
-        let labels = [];
-        let rawData = [];
-        let smoothData = [];
-        let labelText = "";
-        let isNavigable = false;
+    function parseDateUTC(isoDate) {
+        const [y, m, d] = isoDate.split('-').map(Number);
+        return new Date(Date.UTC(y, m - 1, d));
+    }
 
-        // =========================================================
-        // VIEW: LAST 30 DAYS 
-        // =========================================================
+    function getLabelText(viewType, offset, series) {
         if (viewType === 'last30') {
-            isNavigable = true;
-            let startDate, endDate;
-
+            const startDate = parseDateUTC(series.start);
             if (offset === 0) {
-                endDate = new Date(); 
-                startDate = new Date();
-                startDate.setDate(endDate.getDate() - 29); 
-                
+                const endDate = parseDateUTC(series.end);
                 const startStr = startDate.toLocaleDateString('ca-ES', { timeZone: 'UTC', day:'numeric', month:'short'});
                 const endStr = endDate.toLocaleDateString('ca-ES', { timeZone: 'UTC', day:'numeric', month:'short'});
-                labelText = `${startStr} - ${endStr}`;
-            } else {
-                const now = new Date();
-                const targetDate = new Date(Date.UTC(now.getUTCFullYear(), now.getUTCMonth() - offset, 1));
-                
-                startDate = new Date(Date.UTC(targetDate.getUTCFullYear(), targetDate.getUTCMonth(), 1));
-                endDate = new Date(Date.UTC(targetDate.getUTCFullYear(), targetDate.getUTCMonth() + 1, 0)); 
-                
-                labelText = startDate.toLocaleDateString('ca-ES', { timeZone: 'UTC', month: 'long', year: 'numeric' });
-                labelText = labelText.charAt(0).toUpperCase() + labelText.slice(1);
-            }
-
-            const curr = new Date(startDate);
-            while (curr <= endDate) {
-                const key = curr.toISOString().split('T')[0];
-                labels.push(key);
-                counts[key] = 0;
-                curr.setDate(curr.getDate() + 1);
-            }
-
-            allDates.forEach(d => {
-                const key = d.toISOString().split('T')[0];
-                if (counts.hasOwnProperty(key)) counts[key]++;
-            });
-
-            rawData = labels.map(k => counts[k]);
-            smoothData = calculateMovingAverage(rawData, SMOOTHING_WINDOWS.last30);
-        } 
-        
-        // =========================================================
-        // VIEW: LAST YEAR 
-        // =========================================================
-        else if (viewType === 'last365') {
-            isNavigable = true;
-            let startDate, endDate;
-
-            if (offset === 0) {
-                endDate = new Date();
-                startDate = new Date();
-                startDate.setDate(endDate.getDate() - 364);
-                labelText = "Últims 365 dies";
-            } else {
-                const targetYear = new Date().getFullYear() - offset;
-                startDate = new Date(Date.UTC(targetYear, 0, 1));
-                endDate = new Date(Date.UTC(targetYear, 11, 31));
-                labelText = `Any ${targetYear}`;
-            }
-
-            const curr = new Date(startDate);
-            while (curr <= endDate) {
-                const key = curr.toISOString().split('T')[0];
-                labels.push(key);
-                counts[key] = 0;
-                curr.setDate(curr.getDate() + 1);
+                return `${startStr} - ${endStr}`;
             }
-
-            allDates.forEach(d => {
-                const key = d.toISOString().split('T')[0];
-                if (counts.hasOwnProperty(key)) counts[key]++;
-            });
-
-            rawData = labels.map(k => counts[k]);
-            smoothData = calculateMovingAverage(rawData, SMOOTHING_WINDOWS.last365); 
-        } 
-        
-        // =========================================================
-        // VIEW: MONTHLY
-        // =========================================================
-        else if (viewType === 'monthly') {
-            isNavigable = false; 
-            labelText = "Històric (Mitjana vs Total)";
-            
-            allDates.forEach(d => {
-                const key = d.toISOString().slice(0, 7); 
-                counts[key] = (counts[key] || 0) + 1;
-            });
-
-            labels = Object.keys(counts).sort();
-            
-            const calculatedValues = labels.map(k => {
-                const [y, m] = k.split('-');
-                const dateObj = new Date(Date.UTC(parseInt(y), parseInt(m)-1, 1));
-                const total = counts[k];
-                const daysActive = getDaysActive(dateObj, 'month');
-                return parseFloat((total / daysActive).toFixed(2));
-            });
-
-            smoothData = calculateMovingAverage(calculatedValues, SMOOTHING_WINDOWS.monthly);
-            rawData = []; 
-        } 
-        
-        // =========================================================
-        // VIEW: YEARLY
-        // =========================================================
-        else if (viewType === 'yearly') {
-            isNavigable = false;
-            labelText = "Històric (Mitjana vs Total)";
-
-            allDates.forEach(d => {
-                const key = d.getUTCFullYear().toString(); // UPDATED: UTC
-                counts[key] = (counts[key] || 0) + 1;
-            });
-
-            labels = Object.keys(counts).sort();
-
-            rawData = labels.map(k => {
-                const year = parseInt(k);
-                const dateObj = new Date(Date.UTC(year, 0, 1));
-                const total = counts[k];
-                const daysActive = getDaysActive(dateObj, 'year');
-                return parseFloat((total / daysActive).toFixed(2));
-            });
-
-            smoothData = calculateMovingAverage(rawData, SMOOTHING_WINDOWS.yearly); 
+            const labelText = startDate.toLocaleDateString('ca-ES', { timeZone: 'UTC', month: 'long', year: 'numeric' });
+            return labelText.charAt(0).toUpperCase() + labelText.slice(1);
         }
-
-        // =========================================================
-        // VIEW: HOURLY (15-minute intervals)
-        // =========================================================
-        else if (viewType === 'hours') {
-            isNavigable = false;
-            labelText = "Per hora (15 min)";
-
-            // 1. Generate all 96 intervals (00:00 to 23:45)
-            for (let i = 0; i < 96; i++) {
-                const hours = Math.floor(i / 4);
-                const mins = (i % 4) * 15;
-                const label = `${String(hours).padStart(2, '0')}:${String(mins).padStart(2, '0')}`;
-                labels.push(label);
-                counts[label] = 0;
-            }
-
-            // 2. Fill with Real Data
-            allDates.forEach(d => {
-                const hours = d.getUTCHours();     
-                const mins = d.getUTCMinutes();    
-                // Calculate which 15-min slot this falls into
-                const slot = hours * 4 + Math.floor(mins / 15);
-                
-                // Reconstruct label to match the generated keys
-                const slotHours = Math.floor(slot / 4);
-                const slotMins = (slot % 4) * 15;
-                const label = `${String(slotHours).padStart(2, '0')}:${String(slotMins).padStart(2, '0')}`;
-                
-                if (counts.hasOwnProperty(label)) counts[label]++;
-            });
-
-            rawData = labels.map(k => counts[k]);
-            
-            // 3. APPLY SMOOTHING OF 2 (As requested)
-            smoothData = calculateMovingAverage(rawData, 2);
+        if (viewType === 'last365') {
+            return offset === 0 ? "Últims 365 dies" : `Any ${series.start.slice(0, 4)}`;
+        }
+        if (viewType === 'hours') {
+            return "Per hora (15 min)";
         }
+        return "Històric (Mitjana vs Total)";
+    }
 
-        return { labels, rawData, smoothData, labelText, isNavigable };
+    async function getDataForView(viewType, offset) {
+        const params = new URLSearchParams({ user_id: selectedUserId, view: viewType, offset: offset });
+        const response = await fetch(`${seriesUrl}?${params}`);
+        const series = await response.json();
+        if (!response.ok) throw new Error(series.error || response.statusText);
+
+        return {
+            labels: series.labels,
+            rawData: series.raw,
+            smoothData: series.smooth,
+            labelText: getLabelText(viewType, offset, series),
+            isNavigable: (viewType === 'last30' || viewType === 'last365')
+        };
     }
 
-    // --- 4. RENDER / UPDATE CHART ---
-    function updateChart() {
+    // --- 3. RENDER / UPDATE CHART ---
+    async function updateChart() {
         const viewSelector = document.getElementById('chartView');
         const viewType = viewSelector.value;
         
-        const { labels, rawData, smoothData, labelText, isNavigable } = getDataForView(viewType, currentOffset);
+        const requestId = ++latestRequest;
+        let data;
+        try {
+            data = await getDataForView(viewType, currentOffset);
+        } catch (err) {
+            console.error('Could not load chart data:', err);
+            return;
+        }
+        // A newer view/offset was requested while this one was loading
+        if (requestId !== latestRequest) return;
+        const { labels, rawData, smoothData, labelText, isNavigable } = data;
 
         document.getElementById('chartDateLabel').textContent = labelText;
         const navDiv = document.getElementById('chartNav');
@@ -437,4 +194,29 @@ document.addEventListener('DOMContentLoaded', function() {
     });
 
     updateChart();
+
+    // --- 4. LIVE UPDATES ---
+    // New and deleted entries arrive over Server-Sent Events when enabled
+    if (eventsUrl && window.EventSource) {
+        const params = new URLSearchParams({ user_id: selectedUserId });
+        const source = new EventSource(`${eventsUrl}?${params}`);
+        let connectedBefore = false;
+
+        source.addEventListener('open', () => {
+            // Changes made while reconnecting weren't delivered
+            if (connectedBefore) updateChart();
+            connectedBefore = true;
+        });
+
+        source.addEventListener('log', (e) => {
+            const change = JSON.parse(e.data);
+            if (summary) {
+                summary.total += change.inserted.length - change.deleted.length;
+                document.getElementById('statTotal').textContent = summary.total.toLocaleString();
+            }
+            updateChart();
+        });
+
+        source.addEventListener('resync', () => updateChart());
+    }
 });
\ No newline at end of file
@@ -0,0 +1,214 @@
+"""
+Dashboard aggregations computed in the database.
+
+The dashboard charts used to receive every log row and bucket them in the
+browser; these helpers return the pre-bucketed series instead. Day-level
+figures read the poop_daily rollup, so their cost grows with the number of
+active days rather than the number of entries.
+"""
+
+import calendar
+from datetime import date, datetime, timedelta
+
+SERIES_VIEWS = ('last30', 'last365', 'monthly', 'yearly', 'hours')
+
+# Moving-average window (in buckets) applied to each view
+SMOOTHING_WINDOWS = {
+    'last30': 3,
+    'last365': 7,
+    'monthly': 1,
+    'yearly': 1,
+    'hours': 2,
+}
+
+
+def moving_average(values, window):
+    """Trailing moving average; the first buckets average over what is available."""
+    if window <= 1:
+        return list(values)
+    result = []
+    running = 0
+    for i, value in enumerate(values):
+        running += value
+        if i >= window:
+            running -= values[i - window]
+        result.append(running / min(i + 1, window))
+    return result
+
+
+def get_summary(cursor, user_id, with_public_users=False):
+    """
+    Return the headline stats shown above the dashboard chart.
+    The 30/365-day windows are whole calendar days, today included.
+
+    With `with_public_users`, the same round trip also fetches the public
+    user directory, returned as (id, username) lists under 'public_users'.
+    """
+    public_users = """,
+               (SELECT COALESCE(json_agg(json_build_array(id, username) ORDER BY id), '[]')
+                FROM users
+                WHERE (config->>'public')::boolean = true)""" if with_public_users else ""
+    cursor.execute(
+        f"""
+        SELECT COALESCE(SUM(count), 0),
+               COALESCE(SUM(count) FILTER (WHERE day > CURRENT_DATE - 30), 0),
+               COALESCE(SUM(count) FILTER (WHERE day > CURRENT_DATE - 365), 0),
+               MIN(first_time),
+               MAX(last_time),
+               (SELECT EXTRACT(HOUR FROM log_time)::int
+                FROM poop
+                WHERE user_id = %s AND log_time >= CURRENT_DATE - 29
+                GROUP BY 1
+                ORDER BY COUNT(*) DESC, 1 ASC
+                LIMIT 1){public_users}
+        FROM poop_daily
+        WHERE user_id = %s
+        """,
+        (user_id, user_id)
+    )
+    row = cursor.fetchone()
+    total, count30, count365, first_log, last_log, peak_hour = row[:6]
+
+    avg_ever = 0.0
+    if first_log:
+        days_active = max(1, (datetime.now() - first_log).days)
+        avg_ever = total / days_active
+
+    summary = {
+        'total': total,
+        'avg_30': count30 / 30,
+        'avg_365': count365 / 365,
+        'avg_ever': avg_ever,
+        'peak_hour': peak_hour,
+        'last_log': last_log,
+    }
+    if with_public_users:
+        summary['public_users'] = row[6]
+    return summary
+
+
+def humanize_last_entry(dt_obj):
+    """Format the most recent entry time in a visual way (Today, Yesterday, etc.)."""
+    if not dt_obj:
+        return None
+    today = datetime.now().date()
+    entry_date = dt_obj.date()
+    time_str = dt_obj.strftime('%H:%M')
+
+    if entry_date == today:
+        return f"Avui: {time_str}"
+    if entry_date == today - timedelta(days=1):
+        return f"Ahir: {time_str}"
+    days_ago = (today - entry_date).days
+    return f"Fa {days_ago} dies a les {time_str}"
+
+
+def _daily_range(view, offset, today):
+    """Return the (start, end) dates covered by a navigable daily view."""
+    if view == 'last30':
+        if offset == 0:
+            return today - timedelta(days=29), today
+        month_index = today.year * 12 + today.month - 1 - offset
+        year, month = divmod(month_index, 12)
+        month += 1
+        return date(year, month, 1), date(year, month, calendar.monthrange(year, month)[1])
+
+    if offset == 0:
+        return today - timedelta(days=364), today
+    year = today.year - offset
+    return date(year, 1, 1), date(year, 12, 31)
+
+
+def _daily_series(cursor, user_id, view, offset):
+    start, end = _daily_range(view, offset, date.today())
+    cursor.execute(
+        """
+        SELECT d::date,
+               COALESCE(c.count, 0),
+               AVG(COALESCE(c.count, 0)) OVER (ORDER BY d ROWS BETWEEN %s PRECEDING AND CURRENT ROW)
+        FROM generate_series(%s::date, %s::date, INTERVAL '1 day') AS d
+        LEFT JOIN poop_daily c
+            ON c.user_id = %s AND c.day = d::date
+        ORDER BY d
+        """,
+        (SMOOTHING_WINDOWS[view] - 1, start, end, user_id)
+    )
+    rows = cursor.fetchall()
+    return {
+        'labels': [row[0].isoformat() for row in rows],
+        'raw': [row[1] for row in rows],
+        'smooth': [float(row[2]) for row in rows],
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+    }
+
+
+def _days_active(bucket, today, unit):
+    """Days of a month/year bucket that have elapsed (the whole period if it's over)."""
+    if unit == 'month':
+        if (bucket.year, bucket.month) == (today.year, today.month):
+            return today.day
+        return calendar.monthrange(bucket.year, bucket.month)[1]
+    if bucket.year == today.year:
+        return today.timetuple().tm_yday
+    return 366 if calendar.isleap(bucket.year) else 365
+
+
+def _period_series(cursor, user_id, view):
+    unit = 'month' if view == 'monthly' else 'year'
+    cursor.execute(
+        """
+        SELECT date_trunc(%s, day)::date AS bucket, SUM(count)
+        FROM poop_daily
+        WHERE user_id = %s
+        GROUP BY 1
+        ORDER BY 1
+        """,
+        (unit, user_id)
+    )
+    rows = cursor.fetchall()
+    today = date.today()
+    fmt = '%Y-%m' if unit == 'month' else '%Y'
+    labels = [row[0].strftime(fmt) for row in rows]
+    averages = [round(row[1] / _days_active(row[0], today, unit), 2) for row in rows]
+    smooth = moving_average(averages, SMOOTHING_WINDOWS[view])
+
+    # The monthly chart only draws the trend line
+    raw = [] if view == 'monthly' else averages
+    return {'labels': labels, 'raw': raw, 'smooth': smooth}
+
+
+def _hours_series(cursor, user_id):
+    # Time of day isn't kept in the rollup, so this one reads the raw logs
+    cursor.execute(
+        """
+        SELECT (EXTRACT(HOUR FROM log_time) * 4 + FLOOR(EXTRACT(MINUTE FROM log_time) / 15))::int AS slot,
+               COUNT(*)
+        FROM poop
+        WHERE user_id = %s
+        GROUP BY 1
+        """,
+        (user_id,)
+    )
+    counts = [0] * 96
+    for slot, count in cursor.fetchall():
+        counts[slot] = count
+    labels = [f"{slot // 4:02d}:{(slot % 4) * 15:02d}" for slot in range(96)]
+    return {'labels': labels, 'raw': counts, 'smooth': moving_average(counts, SMOOTHING_WINDOWS['hours'])}
+
+
+def get_series(cursor, user_id, view, offset=0):
+    """Return the labels, raw counts and smoothed trend for one dashboard chart view."""
+    if view not in SERIES_VIEWS:
+        raise ValueError(f"Unknown series view: {view}")
+
+    if view in ('last30', 'last365'):
+        series = _daily_series(cursor, user_id, view, max(0, offset))
+    elif view in ('monthly', 'yearly'):
+        series = _period_series(cursor, user_id, view)
+    else:
+        series = _hours_series(cursor, user_id)
+
+    series['view'] = view
+    series['offset'] = offset
+    return series
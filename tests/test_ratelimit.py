@@ -0,0 +1,55 @@
+import os
+
+for name in ('DATABASE_HOST', 'DATABASE_USER', 'DATABASE_PASSWORD', 'DATABASE_NAME'):
+    os.environ.setdefault(name, 'test')
+
+import pytest
+from flask import Blueprint, Flask
+
+import ratelimit
+from cache import MemoryBackend
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(ratelimit, '_limiter', ratelimit.RateLimiter(MemoryBackend()))
+
+    auth_bp = Blueprint('auth', __name__)
+    api_bp = Blueprint('api', __name__)
+
+    @auth_bp.route('/register', methods=['GET', 'POST'])
+    def register():
+        return 'ok'
+
+    @api_bp.route('/stats', methods=['GET'])
+    def api_stats():
+        return {'ok': True}
+
+    app = Flask(__name__)
+    app.register_blueprint(auth_bp)
+    app.register_blueprint(api_bp, url_prefix='/api')
+    app.before_request(ratelimit.check_rate_limits)
+    return app.test_client()
+
+
+def test_register_form_views_are_not_limited(client):
+    limit, _ = ratelimit.RATE_LIMITS['auth.register']['ip']
+    for _ in range(limit + 1):
+        assert client.get('/register').status_code == 200
+
+
+def test_register_posts_are_limited(client):
+    limit, _ = ratelimit.RATE_LIMITS['auth.register']['ip']
+    for _ in range(limit):
+        assert client.post('/register', data={'email': 'a@example.com'}).status_code == 200
+    response = client.post('/register', data={'email': 'a@example.com'})
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) > 0
+
+
+def test_api_credentials_on_get_are_limited(client):
+    limit, _ = ratelimit.RATE_LIMITS['api.credentials']['email']
+    body = {'email': 'a@example.com', 'password': 'wrong'}
+    for _ in range(limit):
+        assert client.get('/api/stats', json=body).status_code == 200
+    assert client.get('/api/stats', json=body).status_code == 429